@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+"""Benchmark the column-scoring code on synthetic columns, so that its
+throughput can be measured (and regressions caught) without a real
+HAL file, cactus, or an aligner and tree estimator.
+
+Each column is a random HAL-like tree (every node is a segment in a
+genome, and its children are segments in the child genomes, with
+several copies in a genome representing duplications) with a given
+number of leaves. A given fraction of the leaves come from
+duplications. The "estimated" tree is the true tree with some leaves
+swapped around. All columns share a random species tree.
+
+In the default, in-process mode, the columns are reconciled and scored
+(sampleCoalescences, matchCoalescences, reportCorrectCoalescences)
+directly. With --pipeline, a whole ScoreColumns job is run instead,
+with the stand-ins in standIns/ replacing getRegionAroundSampledColumn
+and the tree estimator (and cat as the aligner). Either way the
+results are then summarized by Summarize.
+
+Each configuration runs in a separate process, to measure its peak
+memory usage. The results can be saved as a baseline, or compared
+against a saved baseline, failing if the throughput drops or memory
+usage rises by more than --tolerance."""
+from argparse import ArgumentParser, Namespace
+from collections import Counter
+from array import array
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from reconciliation import TreeNode, preOrder, parseNewick, writeNewick, NodeTree, collapseUnnecessaryNodes, reconcileGeneTree
+from scoreHalPhylogenies import SpeciesTree, ScoreColumns, Summarize, CoalescenceCounts, splitJobOutputs, RECORD_TYPECODE
+from localExecutor import runTarget
+
+STAND_IN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "standIns")
+
+def getRandomSpeciesTree(numGenomes):
+    """Get a random binary species tree with leaves g0, g1, ... and
+    ancestors a0, a1, ..."""
+    nodes = [TreeNode("g%d" % i) for i in xrange(numGenomes)]
+    numAncestors = 0
+    while len(nodes) > 1:
+        node1 = nodes.pop(random.randrange(len(nodes)))
+        node2 = nodes.pop(random.randrange(len(nodes)))
+        parent = TreeNode("a%d" % numAncestors)
+        numAncestors += 1
+        parent.addChild(node1)
+        parent.addChild(node2)
+        nodes.append(parent)
+    return nodes[0]
+
+def simulateColumnTree(speciesRoot, numLeaves, positionCounts):
+    """Get a random HAL-like column tree with numLeaves leaves (at least
+    one per extant genome), named genome.chr1|pos in the same way as
+    getRegionAroundSampledColumn's output. positionCounts tracks the
+    last position used in each genome so that names are unique."""
+    def newSegment(species):
+        positionCounts[species.label] += 1
+        return TreeNode("%s.chr1|%d" % (species.label, positionCounts[species.label]))
+
+    # Start with one copy in each genome.
+    speciesOf = {}
+    segments = {}
+    nonRootSegments = []
+    for species in preOrder(speciesRoot):
+        segment = newSegment(species)
+        speciesOf[segment] = species
+        segments[species] = segment
+        if species.parent is not None:
+            segments[species.parent].addChild(segment)
+            nonRootSegments.append(segment)
+    root = segments[speciesRoot]
+    leafCount = sum(1 for species in segments if species.isLeaf())
+
+    # Then add duplicated copies of random segments, each with a single
+    # line of descent to an extant genome, until there are enough
+    # leaves.
+    while leafCount < numLeaves:
+        segment = random.choice(nonRootSegments)
+        species = speciesOf[segment]
+        copy = newSegment(species)
+        speciesOf[copy] = species
+        segment.parent.addChild(copy)
+        nonRootSegments.append(copy)
+        while not species.isLeaf():
+            species = random.choice(species.children)
+            child = newSegment(species)
+            speciesOf[child] = species
+            copy.addChild(child)
+            nonRootSegments.append(child)
+            copy = child
+        leafCount += 1
+    return root
+
+def randomlyBinarize(root):
+    """Randomly resolve the multifurcations in a tree."""
+    for node in preOrder(root):
+        while len(node.children) > 2:
+            child1 = node.children.pop(random.randrange(len(node.children)))
+            child2 = node.children.pop(random.randrange(len(node.children)))
+            newNode = TreeNode()
+            node.addChild(newNode)
+            newNode.addChild(child1)
+            newNode.addChild(child2)
+
+def getEstimatedTree(halNewick, errorRate):
+    """Get a stand-in for the estimated tree of a column: its leaves-only
+    tree, randomly binarized, with each leaf swapped with a random leaf
+    with probability errorRate."""
+    root = collapseUnnecessaryNodes(parseNewick(halNewick))
+    leaves = []
+    for node in preOrder(root):
+        if node.isLeaf():
+            leaves.append(node)
+        else:
+            node.label = ""
+        node.branchLength = 0.1
+    randomlyBinarize(root)
+    for leaf in leaves:
+        if random.random() < errorRate:
+            other = random.choice(leaves)
+            leaf.label, other.label = other.label, leaf.label
+    return writeNewick(root)
+
+def getColumnPath(workloadDir, position, suffix):
+    return os.path.join(workloadDir, "%s_%d%s" % (position[0], position[1], suffix))
+
+def makeWorkload(workloadDir, numColumns, numLeaves, duplicationRate, errorRate, width):
+    """Write the species tree, the columns (in the format
+    getRegionAroundSampledColumn outputs) and their estimated trees to
+    workloadDir. Returns the species tree newick and the reference
+    positions, which are in genome g0."""
+    numGenomes = max(2, int(round(numLeaves * (1 - duplicationRate))))
+    speciesRoot = getRandomSpeciesTree(numGenomes)
+    positionCounts = Counter()
+    positions = []
+    for _ in xrange(numColumns):
+        halRoot = simulateColumnTree(speciesRoot, max(numLeaves, numGenomes), positionCounts)
+        halNewick = writeNewick(halRoot)
+        leafNames = [node.label for node in preOrder(halRoot) if node.isLeaf()]
+        refLeaf = random.choice([name for name in leafNames if name.split(".")[0] == "g0"])
+        position = (refLeaf.split(".")[1].split("|")[0], int(refLeaf.split("|")[1]))
+        positions.append(position)
+        columnFile = open(getColumnPath(workloadDir, position, ".fa"), 'w')
+        columnFile.write("#%s\n" % halNewick)
+        for name in leafNames:
+            columnFile.write(">%s\n%s\n" % (name, "".join(random.choice("ACGT") for _ in xrange(width))))
+        columnFile.close()
+        # The stand-in estimator finds the tree by the column's first
+        # sequence name.
+        treeFile = open(os.path.join(workloadDir, leafNames[0] + ".nwk"), 'w')
+        treeFile.write(getEstimatedTree(halNewick, errorRate) + "\n")
+        treeFile.close()
+    speciesNewick = writeNewick(speciesRoot)
+    open(os.path.join(workloadDir, "speciesTree.nwk"), 'w').write(speciesNewick + "\n")
+    return speciesNewick, positions
+
+def getScoringOpts(args, workloadDir, outputFile):
+    """Get the scoreHalPhylogenies options for scoring the workload."""
+    return Namespace(halFile=workloadDir, refGenome="g0", outputFile=outputFile,
+                     width=args.width, alignerCommand="cat",
+                     estimatorCommand="%s %s" % (os.path.join(STAND_IN_DIR, "standInEstimator.py"), workloadDir),
+                     columnTempDir=None, reconcileInProcess=True, cacheDir=None,
+                     costReport=None, columnStats=None, xmlColumnStats=False,
+                     writeMismatchesToFile=None,
+                     workersPerJob=args.workersPerJob, onlySelf=False,
+                     nonDuplicated=False, coalescencesPerSample=args.coalescencesPerSample,
+                     allPairs=args.allPairs, prefilterStats=None)
+
+def scoreInProcess(scorer, workloadDir, speciesTree):
+    """Reconcile and score every column in the same way as
+    ScoreColumns.prepareColumn, but without running any commands."""
+    columns = []
+    for position in scorer.positions:
+        fastaLines = open(getColumnPath(workloadDir, position, ".fa")).read().split("\n")
+        seqNames = [l[1:] for l in fastaLines if len(l) > 0 and l[0] == '>']
+        estimatedNewick = open(os.path.join(workloadDir, seqNames[0] + ".nwk")).read().strip()
+        columns.append((position, fastaLines[0][1:], seqNames, estimatedNewick))
+    startTime = time.time()
+    if scorer.opts.allPairs:
+        scorer.allPairsCounts = CoalescenceCounts(speciesTree.genomes)
+    for position, halNewick, seqNames, estimatedNewick in columns:
+        if scorer.getSkipReason(position, seqNames) is not None:
+            continue
+        leafToSpecies = dict((name, name.split(".")[0]) for name in seqNames)
+        reconciled = reconcileGeneTree(parseNewick(estimatedNewick),
+                                       speciesTree.reconciliationIndex,
+                                       leafToSpecies, reRoot=True)
+        scorer.reportCorrectCoalescences(position, halNewick, NodeTree(reconciled))
+    if scorer.opts.allPairs:
+        scorer.allPairsCounts.writeCounts(scorer.outputFile)
+    return startTime
+
+def runConfiguration(args, workloadDir, speciesNewick, positions, pipeline):
+    """Score and summarize a workload, returning its metrics."""
+    random.seed(args.seed)
+    workDir = tempfile.mkdtemp(dir=workloadDir)
+    outputFile = os.path.join(workDir, "records")
+    opts = getScoringOpts(args, workloadDir, outputFile)
+    speciesTree = SpeciesTree(speciesNewick)
+    scorer = ScoreColumns(opts, positions, outputFile, speciesTree, set(positions))
+    if pipeline:
+        os.environ['PATH'] = STAND_IN_DIR + os.pathsep + os.environ['PATH']
+        startTime = time.time()
+        result = runTarget(scorer, workDir)
+    else:
+        startTime = scoreInProcess(scorer, workloadDir, speciesTree)
+        result = ('success',)
+    if result[0] == 'success':
+        recordFiles, countFiles = splitJobOutputs(opts, [outputFile])
+        result = runTarget(Summarize(opts, recordFiles, os.path.join(workDir, "results.xml"),
+                                     None, speciesTree, countFiles), workDir)
+    if result[0] == 'error':
+        raise RuntimeError(result[1])
+    elapsed = time.time() - startTime
+    numCoalescences = 0
+    if opts.allPairs:
+        counts = CoalescenceCounts(speciesTree.genomes)
+        counts.addCounts(outputFile)
+        numCoalescences = sum(counts.counts)
+    elif os.path.exists(outputFile):
+        numCoalescences = os.path.getsize(outputFile) / array(RECORD_TYPECODE).itemsize
+    return {'columnsPerSecond': len(positions) / elapsed,
+            'coalescencesPerSecond': numCoalescences / elapsed,
+            'peakRSS': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'seconds': elapsed,
+            'coalescences': numCoalescences}
+
+def runInNewProcess(function, *args):
+    """Run function(*args) in a fresh process and return its result."""
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        return pool.apply(function, args)
+    finally:
+        pool.terminate()
+        pool.join()
+
+def getRegressions(name, metrics, baselineMetrics, tolerance):
+    """Get a description of each metric that is worse than its
+    baseline by more than the tolerance (a fraction)."""
+    regressions = []
+    for metric in ['columnsPerSecond', 'coalescencesPerSecond']:
+        if metrics[metric] < baselineMetrics[metric] * (1 - tolerance):
+            regressions.append("%s: %s dropped from %f to %f" % (name, metric, baselineMetrics[metric], metrics[metric]))
+    if metrics['peakRSS'] > baselineMetrics['peakRSS'] * (1 + tolerance):
+        regressions.append("%s: peakRSS rose from %d to %d KB" % (name, baselineMetrics['peakRSS'], metrics['peakRSS']))
+    return regressions
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--leafCounts', help='comma-separated numbers of'
+                        ' leaves per column to benchmark', default='8,32,128')
+    parser.add_argument('--duplicationRates', help='comma-separated fractions'
+                        ' of leaves that come from duplications',
+                        default='0.1,0.3')
+    parser.add_argument('--numColumns', type=int, help='Number of columns per'
+                        ' configuration', default=500)
+    parser.add_argument('--errorRate', type=float, help='probability of each'
+                        ' leaf being misplaced in the estimated tree',
+                        default=0.05)
+    parser.add_argument('--width', type=int, help='Length of the synthetic'
+                        ' sequences', default=200)
+    parser.add_argument('--coalescencesPerSample', type=int,
+                        help='maximum number of coalescences to sample per column',
+                        default=10)
+    parser.add_argument('--workersPerJob', type=int, help='workers to use'
+                        ' with --pipeline', default=1)
+    parser.add_argument('--allPairs', action='store_true', default=False,
+                        help='score every pair in each column')
+    parser.add_argument('--pipeline', action='store_true', default=False,
+                        help='run whole ScoreColumns jobs with the stand-in'
+                        ' commands instead of scoring in-process')
+    parser.add_argument('--seed', type=int, help='random seed', default=0)
+    parser.add_argument('--baseline', help='compare against the baseline in'
+                        ' this JSON file (if it exists), exiting with status 1'
+                        ' on regressions')
+    parser.add_argument('--saveBaseline', help='save the results as a baseline'
+                        ' to this JSON file')
+    parser.add_argument('--tolerance', type=float, help='fraction by which a'
+                        ' metric can be worse than the baseline before it'
+                        ' counts as a regression', default=0.2)
+    args = parser.parse_args()
+
+    results = {}
+    regressions = []
+    baseline = {}
+    if args.baseline is not None:
+        if os.path.exists(args.baseline):
+            baseline = json.load(open(args.baseline))
+        else:
+            # Baselines are machine-specific, so none are checked in.
+            sys.stderr.write("No baseline at %s, so not comparing against one. Run \"make "
+                             "baseline\" (or use --saveBaseline) to record one.\n" % (args.baseline))
+    print "\t".join(["#configuration", "seconds", "columnsPerSecond", "coalescences",
+                     "coalescencesPerSecond", "peakRSS"])
+    for numLeaves in [int(i) for i in args.leafCounts.split(",")]:
+        for duplicationRate in [float(i) for i in args.duplicationRates.split(",")]:
+            name = "leaves=%d,duplicationRate=%g,%s" % (numLeaves, duplicationRate,
+                                                        "pipeline" if args.pipeline else "inProcess")
+            if args.allPairs:
+                name += ",allPairs"
+            random.seed(args.seed)
+            workloadDir = tempfile.mkdtemp(prefix="benchmarkScoring")
+            try:
+                speciesNewick, positions = makeWorkload(workloadDir, args.numColumns, numLeaves,
+                                                        duplicationRate, args.errorRate, args.width)
+                metrics = runInNewProcess(runConfiguration, args, workloadDir, speciesNewick,
+                                          positions, args.pipeline)
+            finally:
+                shutil.rmtree(workloadDir, ignore_errors=True)
+            results[name] = metrics
+            print "%s\t%f\t%f\t%d\t%f\t%d" % (name, metrics['seconds'], metrics['columnsPerSecond'],
+                                              metrics['coalescences'], metrics['coalescencesPerSecond'],
+                                              metrics['peakRSS'])
+            sys.stdout.flush()
+            if name in baseline:
+                regressions.extend(getRegressions(name, metrics, baseline[name], args.tolerance))
+
+    if args.saveBaseline is not None:
+        json.dump(results, open(args.saveBaseline, 'w'), indent=2, sort_keys=True)
+    if len(regressions) != 0:
+        sys.stderr.write("Regressions relative to %s:\n%s\n" % (args.baseline, "\n".join(regressions)))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
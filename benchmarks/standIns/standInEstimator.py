@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+"""Stand-in tree estimator for benchmarks. Reads a fasta on stdin and
+prints the tree that benchmarkScoring.py stored for it in the given
+workload directory.
+
+Usage: standInEstimator.py workloadDir < fasta"""
+import os
+import sys
+
+# readline, since iterating over sys.stdin reads ahead, which can't be
+# mixed with sys.stdin.read().
+for line in iter(sys.stdin.readline, ''):
+    if line[0] == '>':
+        firstName = line[1:].strip()
+        break
+# Read the rest, as a real estimator would.
+sys.stdin.read()
+sys.stdout.write(open(os.path.join(sys.argv[1], firstName + ".nwk")).read())
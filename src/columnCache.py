@@ -0,0 +1,119 @@
+"""On-disk cache of the expensive per-column results (the hal tree,
+the realignment, and the reconciled estimated tree) so that reruns
+that only change the scoring options can skip extraction, alignment,
+tree estimation and reconciliation.
+
+Entries are content-addressed by a hash of everything that determines
+them, written atomically, and evicted least-recently-used-first once
+the cache grows past its size limit. Many jobs can share a cache
+directory at once."""
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import zlib
+
+def getFileDigest(path, chunkSize=1 << 20):
+    """Get the SHA-1 hex digest of a file's contents."""
+    digest = hashlib.sha1()
+    fileHandle = open(path, 'rb')
+    while True:
+        chunk = fileHandle.read(chunkSize)
+        if len(chunk) == 0:
+            break
+        digest.update(chunk)
+    fileHandle.close()
+    return digest.hexdigest()
+
+class ColumnCache:
+    """A directory of cached column results, bounded to maxSize bytes.
+
+    keyParams is a list of strings that, together with the position,
+    determine a column's results (hal digest, reference genome, width,
+    aligner/estimator commands, etc.)."""
+    def __init__(self, cacheDir, maxSize, keyParams):
+        self.cacheDir = cacheDir
+        self.maxSize = maxSize
+        self.keyParams = keyParams
+
+    def getPath(self, position):
+        key = hashlib.sha1("\t".join(self.keyParams + [position[0], str(position[1])])).hexdigest()
+        return os.path.join(self.cacheDir, key[:2], key)
+
+    def get(self, position):
+        """Get the cached (halTree, alignment, reconciledNewick) for a
+        position, or None if it isn't cached."""
+        path = self.getPath(position)
+        try:
+            entry = json.loads(zlib.decompress(open(path, 'rb').read()))
+        except (IOError, OSError, ValueError, zlib.error):
+            # Missing, evicted, or (somehow) corrupt.
+            return None
+        try:
+            # Mark as recently used.
+            os.utime(path, None)
+        except OSError:
+            pass
+        return (entry['halTree'], entry['alignment'], entry['reconciled'])
+
+    def put(self, position, halTree, alignment, reconciledNewick):
+        path = self.getPath(position)
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        data = zlib.compress(json.dumps({'halTree': halTree,
+                                         'alignment': alignment,
+                                         'reconciled': reconciledNewick}))
+        # Write to a temporary file and rename it into place, so
+        # concurrent readers never see a partial entry.
+        fd, tempPath = tempfile.mkstemp(dir=directory, prefix='.tmp')
+        os.write(fd, data)
+        os.close(fd)
+        os.rename(tempPath, path)
+
+    def evict(self):
+        """Delete the least recently used entries until the cache is
+        under its size limit. Skipped if another job is already
+        evicting."""
+        try:
+            os.makedirs(self.cacheDir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        lockHandle = open(os.path.join(self.cacheDir, 'lock'), 'a')
+        try:
+            fcntl.flock(lockHandle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lockHandle.close()
+            return
+        try:
+            entries = []
+            totalSize = 0
+            for directory, _, files in os.walk(self.cacheDir):
+                for name in files:
+                    if name == 'lock' or name.startswith('.tmp'):
+                        continue
+                    path = os.path.join(directory, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+                    totalSize += stat.st_size
+            entries.sort()
+            for _, size, path in entries:
+                if totalSize <= self.maxSize:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                totalSize -= size
+        finally:
+            fcntl.flock(lockHandle, fcntl.LOCK_UN)
+            lockHandle.close()
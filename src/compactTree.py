@@ -0,0 +1,233 @@
+"""A compact, read-only tree parsed straight from newick into flat
+arrays, for code that parses and walks many small trees. Much cheaper
+to build and keep around than an NXTree (a networkx DiGraph
+underneath) or a tree of node objects.
+
+Node ids are assigned in pre-order, so the root is 0, the subtree
+under a node is the contiguous range of ids [id, subtreeEnds[id]),
+and leaves are in left-to-right order when sorted by id."""
+from array import array
+import re
+
+# Either a single structural character or a run of label/branch-length
+# text.
+NEWICK_TOKEN_RE = re.compile(r'[(),]|[^(),]+')
+
+class CompactTree(object):
+    """Parent, first-child, next-sibling, depth and subtree-end arrays
+    indexed by node id (-1 where there is no such node), along with
+    names ("" if missing) and branch lengths (None if missing).
+    Provides the subset of the NXTree interface used by the scoring
+    code."""
+    __slots__ = ['names', 'branchLengths', 'parents', 'firstChildren', 'nextSiblings',
+                 'depths', 'subtreeEnds', 'leafIds']
+
+    def __init__(self, names, branchLengths, parents, firstChildren, nextSiblings, depths):
+        self.names = names
+        self.branchLengths = branchLengths
+        self.parents = parents
+        self.firstChildren = firstChildren
+        self.nextSiblings = nextSiblings
+        self.depths = depths
+        numNodes = len(names)
+        # Children always have larger ids than their parents, so the
+        # subtree sizes can be summed up in reverse id order.
+        subtreeSizes = array('i', [1]) * numNodes
+        for id in xrange(numNodes - 1, 0, -1):
+            subtreeSizes[parents[id]] += subtreeSizes[id]
+        self.subtreeEnds = array('i', (id + size for id, size in enumerate(subtreeSizes)))
+        self.leafIds = array('i', (id for id in xrange(numNodes) if firstChildren[id] == -1))
+
+    def __len__(self):
+        return len(self.names)
+
+    def getRootId(self):
+        return 0
+
+    def getChildren(self, id):
+        children = []
+        child = self.firstChildren[id]
+        while child != -1:
+            children.append(child)
+            child = self.nextSiblings[child]
+        return children
+
+    def hasParent(self, id):
+        return self.parents[id] != -1
+
+    def getParent(self, id):
+        return self.parents[id]
+
+    def hasName(self, id):
+        return self.names[id] != ""
+
+    def getName(self, id):
+        return self.names[id]
+
+    def isLeaf(self, id):
+        return self.firstChildren[id] == -1
+
+    def isAncestor(self, ancestor, id):
+        """Check whether ancestor is id or one of its ancestors."""
+        return ancestor <= id < self.subtreeEnds[ancestor]
+
+    def preOrderTraversal(self):
+        return xrange(len(self.names))
+
+    def postOrderTraversal(self):
+        """Get the node ids in post-order, visiting children in
+        left-to-right order."""
+        ret = []
+        # Each node is output once the last node of its subtree has
+        # been reached, which is in pre-order.
+        pending = []
+        for id in xrange(len(self.names)):
+            pending.append(id)
+            while len(pending) != 0 and self.subtreeEnds[pending[-1]] == id + 1:
+                ret.append(pending.pop())
+        return ret
+
+    def getLeafNames(self):
+        """Get the leaf names, in left-to-right order."""
+        names = self.names
+        return [names[id] for id in self.leafIds if names[id] != ""]
+
+    def getNameToId(self):
+        """Get a mapping from name to id for all named nodes."""
+        return dict((name, id) for id, name in enumerate(self.names) if name != "")
+
+    def toNewick(self):
+        """Get a newick string for the tree."""
+        strings = []
+        for id in self.postOrderTraversal():
+            # The strings of an internal node's children are on top of
+            # the stack, leftmost child deepest.
+            numChildren = len(self.getChildren(id))
+            suffix = self.names[id]
+            if self.branchLengths[id] is not None:
+                suffix += ":" + repr(self.branchLengths[id])
+            if numChildren == 0:
+                strings.append(suffix)
+            else:
+                childStrings = strings[len(strings) - numChildren:]
+                del strings[len(strings) - numChildren:]
+                strings.append("(%s)%s" % (",".join(childStrings), suffix))
+        return strings[0] + ";"
+
+    def getInducedNewick(self, keepLeaves):
+        """Get a newick string for the tree induced on the leaves for
+        which keepLeaves (an array of booleans indexed by id) is true.
+        Only the nodes with a kept leaf below them are written, and
+        nodes left with a single child are collapsed into it, adding
+        their branch lengths to the child's. Linear in the size of the
+        tree."""
+        parents = self.parents
+        keptLeaves = array('i', [0]) * len(self.names)
+        for id in self.leafIds:
+            if keepLeaves[id]:
+                keptLeaves[id] = 1
+        for id in xrange(len(self.names) - 1, 0, -1):
+            keptLeaves[parents[id]] += keptLeaves[id]
+        if keptLeaves[0] == 0:
+            return ";"
+
+        def getKeptChildren(id):
+            return [child for child in self.getChildren(id) if keptLeaves[child] != 0]
+
+        def skipCollapsed(id):
+            # Get the first node at or below id that isn't collapsed,
+            # its branch length including those of the collapsed nodes
+            # above it, and its kept children.
+            branchLength = self.branchLengths[id]
+            children = getKeptChildren(id)
+            while len(children) == 1:
+                id = children[0]
+                if self.branchLengths[id] is not None:
+                    branchLength = (branchLength or 0.0) + self.branchLengths[id]
+                children = getKeptChildren(id)
+            return id, branchLength, children
+
+        # The stack holds nodes yet to be written and the text that
+        # closes their parents.
+        tokens = []
+        stack = [skipCollapsed(0)]
+        while len(stack) != 0:
+            item = stack.pop()
+            if isinstance(item, str):
+                tokens.append(item)
+                continue
+            id, branchLength, children = item
+            suffix = self.names[id]
+            if branchLength is not None:
+                suffix += ":" + repr(branchLength)
+            if len(children) == 0:
+                tokens.append(suffix)
+                continue
+            tokens.append("(")
+            stack.append(")" + suffix)
+            for i in xrange(len(children) - 1, -1, -1):
+                stack.append(skipCollapsed(children[i]))
+                if i != 0:
+                    stack.append(",")
+        return "".join(tokens) + ";"
+
+def parseCompactNewick(newick, translate=None):
+    """Parse a newick string into a CompactTree. If given, translate
+    maps labels to the names to use instead (labels not in it are kept
+    as they are)."""
+    newick = newick.strip()
+    if newick.endswith(";"):
+        newick = newick[:-1]
+    names = [""]
+    branchLengths = [None]
+    parents = array('i', [-1])
+    firstChildren = array('i', [-1])
+    nextSiblings = array('i', [-1])
+    depths = array('i', [0])
+    # The last child added to each node so far, for linking siblings.
+    lastChildren = [-1]
+
+    def addNode(parent):
+        id = len(names)
+        names.append("")
+        branchLengths.append(None)
+        parents.append(parent)
+        firstChildren.append(-1)
+        nextSiblings.append(-1)
+        depths.append(depths[parent] + 1)
+        lastChildren.append(-1)
+        if lastChildren[parent] == -1:
+            firstChildren[parent] = id
+        else:
+            nextSiblings[lastChildren[parent]] = id
+        lastChildren[parent] = id
+        return id
+
+    node = 0
+    for token in NEWICK_TOKEN_RE.findall(newick):
+        if token == '(':
+            node = addNode(node)
+        elif token == ',':
+            if parents[node] == -1:
+                raise RuntimeError("Unbalanced parentheses in newick string %s" % newick)
+            node = addNode(parents[node])
+        elif token == ')':
+            node = parents[node]
+            if node == -1:
+                raise RuntimeError("Unbalanced parentheses in newick string %s" % newick)
+        else:
+            # A label, branch length, or both.
+            token = token.strip()
+            if len(token) == 0:
+                continue
+            if ':' in token:
+                label, branchLength = token.rsplit(':', 1)
+                branchLengths[node] = float(branchLength)
+            else:
+                label = token
+            if translate is not None:
+                label = translate.get(label, label)
+            names[node] = label
+    if node != 0:
+        raise RuntimeError("Unbalanced parentheses in newick string %s" % newick)
+    return CompactTree(names, branchLengths, parents, firstChildren, nextSiblings, depths)
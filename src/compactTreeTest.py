@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""Tests for compactTree.py."""
+import unittest
+from array import array
+
+from compactTree import parseCompactNewick
+from reconciliation import parseNewick, writeNewick, collapseUnnecessaryNodes
+
+TREE = "((a:1,b:2)x:3,(c:4,(d:5)y:6)z:7)r;"
+
+# Leaves to induce TREE on, the output of the old induceTreeOnLeaves in
+# renameNewick.py (which kept every ancestor of a kept leaf, including
+# unary nodes), and the expected getInducedNewick output.
+INDUCED_TREES = [
+    (["a", "b", "c", "d"], "((a:1.0,b:2.0)x:3.0,(c:4.0,(d:5.0)y:6.0)z:7.0)r;",
+     "((a:1.0,b:2.0)x:3.0,(c:4.0,d:11.0)z:7.0)r;"),
+    (["a", "c"], "((a:1.0)x:3.0,(c:4.0)z:7.0)r;", "(a:4.0,c:11.0)r;"),
+    (["a", "b"], "((a:1.0,b:2.0)x:3.0)r;", "(a:1.0,b:2.0)x:3.0;"),
+    (["c", "d"], "((c:4.0,(d:5.0)y:6.0)z:7.0)r;", "(c:4.0,d:11.0)z:7.0;"),
+    (["d"], "(((d:5.0)y:6.0)z:7.0)r;", "d:18.0;"),
+    ([], ";", ";"),
+]
+
+def getInducedNewick(newick, leaves):
+    tree = parseCompactNewick(newick)
+    keepLeaves = array('b', [0]) * len(tree)
+    for id in tree.leafIds:
+        keepLeaves[id] = tree.getName(id) in leaves
+    return tree.getInducedNewick(keepLeaves)
+
+class CompactTreeTest(unittest.TestCase):
+    def testParse(self):
+        tree = parseCompactNewick(TREE)
+        self.assertEqual(tree.getLeafNames(), ["a", "b", "c", "d"])
+        self.assertEqual(tree.getName(tree.getParent(tree.getNameToId()["d"])), "y")
+        self.assertEqual([tree.getName(id) for id in tree.postOrderTraversal()],
+                         ["a", "b", "x", "c", "d", "y", "z", "r"])
+        self.assertEqual(tree.toNewick(), "((a:1.0,b:2.0)x:3.0,(c:4.0,(d:5.0)y:6.0)z:7.0)r;")
+
+    def testTranslate(self):
+        tree = parseCompactNewick("((a,ab)c,b);", {"a": "b", "ab": "a"})
+        self.assertEqual(tree.toNewick(), "((b,a)c,b);")
+
+    def testInducedNewick(self):
+        for leaves, _, expected in INDUCED_TREES:
+            self.assertEqual(getInducedNewick(TREE, leaves), expected)
+        self.assertEqual(getInducedNewick("((a,b),(c,(d)));", ["a", "d"]), "(a,d);")
+
+    def testInducedNewickMatchesOldOutput(self):
+        """Apart from the collapsed unary nodes (including at the
+        root), the induced trees are the same as before."""
+        for leaves, oldOutput, _ in INDUCED_TREES:
+            if len(leaves) == 0:
+                continue
+            collapsed = writeNewick(collapseUnnecessaryNodes(parseNewick(oldOutput)))
+            self.assertEqual(writeNewick(parseNewick(getInducedNewick(TREE, leaves))), collapsed)
+
+if __name__ == '__main__':
+    unittest.main()
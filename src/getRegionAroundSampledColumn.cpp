@@ -1,6 +1,8 @@
 // Samples a column and extracts a FASTA of the region surrounding
 // every column entry.
 #include <time.h>
+#include <fstream>
+#include <map>
 #include "hal.h"
 #include "sonLib.h"
 #include "bioioC.h"
@@ -14,6 +16,13 @@ static void initParser(CLParser &optionsParser)
     optionsParser.addArgument("genome", "reference genome");
     optionsParser.addOption("refSequence", "reference sequence name (by default, a random column will be sampled)", "");
     optionsParser.addOption("refPos", "position (only valid if also using --sequence)", -1);
+    optionsParser.addOption("positionsFile", "file of tab-separated (refSequence, refPos) lines. "
+                            "Every listed column is extracted in order, opening the hal file only once.", "");
+    optionsParser.addOptionFlag("membersOnly", "Instead of extracting the region, print the (tab-separated) "
+                                "reference sequence, reference position, comma-separated genome=count list and "
+                                "comma-separated sequence|position list of the reference genome's entries in each "
+                                "column. Much cheaper than a full extraction.",
+                                false);
     optionsParser.addOption("width", "width of the region around the sampled column to extract, default = 500", 500);
     optionsParser.addOptionFlag("lcaLabeling", "Label the ancestors with the MRCA of the child nodes instead of "
                                  "the ancestral genome and position (useful for comparing to a reconciled tree). "
@@ -174,59 +183,65 @@ static void relabelAncestorsToLCAOfChildren(stTree *tree, stTree *speciesTree) {
     stTree_setLabel(tree, stTree_getLabel(curMRCA));
 }
 
-int main(int argc, char *argv[])
+// Make a sequence name safe for newick parsers (':'->'_')
+static string getSafeSequenceName(const Sequence *seq)
 {
-    CLParser optParser;
-    initParser(optParser);
-    string halPath, genomeName, refSequenceName;
-    hal_index_t refPos = -1;
-    hal_index_t width = 1000;
-    bool lcaLabeling;
-    try {
-        optParser.parseOptions(argc, argv);
-        halPath = optParser.getArgument<string>("halFile");
-        genomeName = optParser.getArgument<string>("genome");
-        refSequenceName = optParser.getOption<string>("refSequence");
-        refPos = optParser.getOption<hal_index_t>("refPos");
-        width = optParser.getOption<hal_index_t>("width");
-        lcaLabeling = optParser.getFlag("lcaLabeling");
-    } catch (exception &e) {
-        cerr << e.what() << endl;
-        optParser.printUsage(cerr);
-        return 1;
+    string seqName = seq->getName();
+    hal_size_t i;
+    while ((i = seqName.find(":")) != string::npos) {
+        seqName[i] = '_';
     }
+    return seqName;
+}
 
-    st_randomSeed(time(NULL));
-
-    AlignmentConstPtr alignment(openHalAlignment(halPath, &optParser));
-    const Genome *genome = alignment->openGenome(genomeName);
-    if (genome == NULL) {
-        throw hal_exception("Genome " + genomeName + " not found in alignment");
+// Print the number of entries from each genome, and the reference
+// genome's entries, in the column containing refPos (a genome
+// coordinate), preceded by the reference sequence name and
+// sequence-relative position. The reference entries are named the same
+// way as in the extracted FASTA headers.
+static void printColumnMembers(const Genome *genome, const Sequence *refSequence, hal_index_t refPos)
+{
+    ColumnIteratorPtr colIt = genome->getColumnIterator(NULL, 0, refPos, NULL_INDEX, false, true);
+    const ColumnIterator::ColumnMap *cols = colIt->getColumnMap();
+    map<string, hal_size_t> genomeCounts;
+    stringstream refEntries;
+    bool firstRefEntry = true;
+    for (ColumnIterator::ColumnMap::const_iterator colMapIt = cols->begin(); colMapIt != cols->end(); colMapIt++) {
+        if (colMapIt->second->empty()) {
+            continue;
+        }
+        const Sequence *seq = colMapIt->first;
+        genomeCounts[seq->getGenome()->getName()] += colMapIt->second->size();
+        if (seq->getGenome() != genome) {
+            continue;
+        }
+        for (ColumnIterator::DNASet::const_iterator dnaIt = colMapIt->second->begin(); dnaIt != colMapIt->second->end(); dnaIt++) {
+            if (!firstRefEntry) {
+                refEntries << ",";
+            }
+            firstRefEntry = false;
+            refEntries << getSafeSequenceName(seq) << "|" << (*dnaIt)->getArrayIndex() - seq->getStartPosition();
+        }
     }
-
-    const Sequence *refSequence = NULL;
-    if (refSequenceName.empty()) {
-        // Sample a position from the entire genome.
-        hal_size_t genomeLen = genome->getSequenceLength();
-        refPos = st_randomInt64(0, genomeLen - 1);
-        refSequence = genome->getSequenceBySite(refPos);
-    } else if (refPos == -1) {
-        refSequence = genome->getSequence(refSequenceName);
-        hal_size_t sequenceLen = refSequence->getSequenceLength();
-        refPos = st_randomInt64(0, sequenceLen - 1);
-        refPos += refSequence->getStartPosition();
-    } else {
-        refSequence = genome->getSequence(refSequenceName);
-        refPos += refSequence->getStartPosition();
+    cout << refSequence->getName() << "\t" << refPos - refSequence->getStartPosition() << "\t";
+    for (map<string, hal_size_t>::const_iterator it = genomeCounts.begin(); it != genomeCounts.end(); it++) {
+        if (it != genomeCounts.begin()) {
+            cout << ",";
+        }
+        cout << it->first << "=" << it->second;
     }
+    cout << "\t" << refEntries.str() << endl;
+}
 
-    char *outputSeq = (char *) malloc((width*2 + 2) * sizeof(char));
-
+// Print the tree (as a FASTA comment) and the region surrounding
+// every entry of the column containing refPos (a genome coordinate).
+static void printColumnRegion(const Genome *genome, hal_index_t refPos, hal_index_t width,
+                              stTree *speciesTree, char *outputSeq)
+{
     ColumnIteratorPtr colIt = genome->getColumnIterator(NULL, 0, refPos, NULL_INDEX, false, true);
 
     stTree *colTree = buildTree(colIt);
-    if (lcaLabeling) {
-        stTree *speciesTree = stTree_parseNewickString(alignment->getNewickTree().c_str());
+    if (speciesTree != NULL) {
         relabelAncestorsToLCAOfChildren(colTree, speciesTree);
     }
 
@@ -274,18 +289,106 @@ int main(int argc, char *argv[])
             }
             outputSeq[size] = '\0';
 
-            // make the sequence name safe for newick parsers (':'->'_')
-            string seqName = seq->getName();
-            hal_size_t i;
-            while ((i = seqName.find(":")) != string::npos) {
-                seqName[i] = '_';
-            }
-
             stringstream header;
-            header << seq->getGenome()->getName() << "." << seqName << "|" << midpoint - seqStart;
+            header << seq->getGenome()->getName() << "." << getSafeSequenceName(seq) << "|" << midpoint - seqStart;
             fastaWrite(outputSeq, (char *) header.str().c_str(), stdout);
         }
     }
+    // Keep the FASTA and the tree lines of consecutive columns in order.
+    fflush(stdout);
+    cout.flush();
+}
+
+int main(int argc, char *argv[])
+{
+    CLParser optParser;
+    initParser(optParser);
+    string halPath, genomeName, refSequenceName, positionsPath;
+    hal_index_t refPos = -1;
+    hal_index_t width = 1000;
+    bool lcaLabeling, membersOnly;
+    try {
+        optParser.parseOptions(argc, argv);
+        halPath = optParser.getArgument<string>("halFile");
+        genomeName = optParser.getArgument<string>("genome");
+        refSequenceName = optParser.getOption<string>("refSequence");
+        refPos = optParser.getOption<hal_index_t>("refPos");
+        positionsPath = optParser.getOption<string>("positionsFile");
+        width = optParser.getOption<hal_index_t>("width");
+        lcaLabeling = optParser.getFlag("lcaLabeling");
+        membersOnly = optParser.getFlag("membersOnly");
+    } catch (exception &e) {
+        cerr << e.what() << endl;
+        optParser.printUsage(cerr);
+        return 1;
+    }
+
+    st_randomSeed(time(NULL));
+
+    AlignmentConstPtr alignment(openHalAlignment(halPath, &optParser));
+    const Genome *genome = alignment->openGenome(genomeName);
+    if (genome == NULL) {
+        throw hal_exception("Genome " + genomeName + " not found in alignment");
+    }
+
+    stTree *speciesTree = NULL;
+    if (lcaLabeling) {
+        speciesTree = stTree_parseNewickString(alignment->getNewickTree().c_str());
+    }
+
+    char *outputSeq = (char *) malloc((width*2 + 2) * sizeof(char));
+
+    if (!positionsPath.empty()) {
+        // Batch mode: extract every listed column from the same open
+        // alignment, so the hal file is only opened once.
+        ifstream positionsFile(positionsPath.c_str());
+        if (!positionsFile) {
+            throw hal_exception("Could not open positions file " + positionsPath);
+        }
+        string line;
+        while (getline(positionsFile, line)) {
+            if (line.empty()) {
+                continue;
+            }
+            stringstream fields(line);
+            hal_index_t seqPos;
+            if (!(fields >> refSequenceName >> seqPos)) {
+                throw hal_exception("Malformed line in positions file: " + line);
+            }
+            const Sequence *refSequence = genome->getSequence(refSequenceName);
+            if (refSequence == NULL) {
+                throw hal_exception("Sequence " + refSequenceName + " not found in genome " + genomeName);
+            }
+            if (membersOnly) {
+                printColumnMembers(genome, refSequence, seqPos + refSequence->getStartPosition());
+            } else {
+                printColumnRegion(genome, seqPos + refSequence->getStartPosition(), width, speciesTree, outputSeq);
+            }
+        }
+        return 0;
+    }
+
+    const Sequence *refSequence = NULL;
+    if (refSequenceName.empty()) {
+        // Sample a position from the entire genome.
+        hal_size_t genomeLen = genome->getSequenceLength();
+        refPos = st_randomInt64(0, genomeLen - 1);
+        refSequence = genome->getSequenceBySite(refPos);
+    } else if (refPos == -1) {
+        refSequence = genome->getSequence(refSequenceName);
+        hal_size_t sequenceLen = refSequence->getSequenceLength();
+        refPos = st_randomInt64(0, sequenceLen - 1);
+        refPos += refSequence->getStartPosition();
+    } else {
+        refSequence = genome->getSequence(refSequenceName);
+        refPos += refSequence->getStartPosition();
+    }
+
+    if (membersOnly) {
+        printColumnMembers(genome, refSequence, refPos);
+    } else {
+        printColumnRegion(genome, refPos, width, speciesTree, outputSeq);
+    }
 
     // Intentionally not dealing with memory leaks for this very
     // short-lived process.
@@ -0,0 +1,155 @@
+"""Run a tree of jobTree-style targets on a single machine with a
+process pool, for small runs where the overhead of jobTree isn't worth
+it. Follows the same rules as jobTree: a target's children all run
+(and finish, along with their own children and follow-ons) before its
+follow-on runs.
+
+Nothing here depends on jobTree."""
+import itertools
+import multiprocessing
+import os
+import Queue
+import shutil
+import tempfile
+import traceback
+
+class LocalTarget(object):
+    """Stand-in base class for targets when jobTree isn't installed.
+    The executor provides the actual target methods."""
+    def __init__(self, time=None, memory=None, cpu=None):
+        pass
+
+# Per-run methods that the executor attaches to a target while it runs.
+TARGET_METHODS = ['addChildTarget', 'setFollowOnTarget', 'getGlobalTempDir', 'getLocalTempDir']
+
+# How often (in seconds) to check on the running targets while waiting
+# for one to finish.
+POLL_INTERVAL = 1.0
+
+def runTarget(target, workDir):
+    """Run a single target (in a worker process), returning either
+    ('success', children, followOn) or ('error', traceback string)."""
+    children = []
+    followOn = []
+    globalTempDir = tempfile.mkdtemp(dir=workDir)
+    localTempDir = tempfile.mkdtemp()
+    target.addChildTarget = children.append
+    target.setFollowOnTarget = lambda followOnTarget: followOn.append(followOnTarget)
+    target.getGlobalTempDir = lambda: globalTempDir
+    target.getLocalTempDir = lambda: localTempDir
+    try:
+        target.run()
+    except:
+        return ('error', traceback.format_exc())
+    finally:
+        for method in TARGET_METHODS:
+            delattr(target, method)
+        shutil.rmtree(localTempDir, ignore_errors=True)
+    return ('success', children, followOn[-1] if len(followOn) != 0 else None)
+
+def getPidPath(workDir, targetId):
+    """Get the path of the file holding the pid of the worker running a
+    target."""
+    return os.path.join(workDir, "target%d.pid" % targetId)
+
+def runTargetInWorker(targetId, target, workDir):
+    """Record which worker is running the target, then run it."""
+    pidPath = getPidPath(workDir, targetId)
+    pidFile = open(pidPath + ".tmp", 'w')
+    pidFile.write("%d\n" % os.getpid())
+    pidFile.close()
+    os.rename(pidPath + ".tmp", pidPath)
+    return runTarget(target, workDir)
+
+def processExists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+class TargetNode:
+    """A running (or waiting) target: its parent, the number of its
+    children that have yet to finish, and its follow-on."""
+    def __init__(self, parent):
+        self.parent = parent
+        self.remainingChildren = 0
+        self.followOn = None
+
+def runLocally(rootTarget, numCores, workDir=None):
+    """Run rootTarget and everything it schedules on numCores
+    processes. Temporary files are kept in workDir (by default, a new
+    temporary directory) until the run finishes."""
+    removeWorkDir = workDir is None
+    if workDir is None:
+        workDir = tempfile.mkdtemp(prefix="localExecutor")
+    pool = multiprocessing.Pool(numCores)
+    finishedQueue = Queue.Queue()
+    # Target id -> (node, AsyncResult) for the targets that haven't
+    # finished.
+    running = {}
+    targetIds = itertools.count()
+
+    def submit(target, parentNode):
+        node = TargetNode(parentNode)
+        targetId = next(targetIds)
+        running[targetId] = (node, pool.apply_async(runTargetInWorker, (targetId, target, workDir),
+                                                    callback=lambda result: finishedQueue.put((targetId, result))))
+
+    def checkRunning():
+        """Raise an error for any target that can't finish: the pool
+        only calls the callback on success, and never finishes the
+        targets of workers that die."""
+        for targetId, (_, asyncResult) in running.items():
+            if asyncResult.ready():
+                if not asyncResult.successful():
+                    # Re-raises the error (e.g. failing to pickle the
+                    # target or its result).
+                    asyncResult.get()
+                continue
+            pidPath = getPidPath(workDir, targetId)
+            if os.path.exists(pidPath):
+                pid = int(open(pidPath).read())
+                if not processExists(pid) and not asyncResult.ready():
+                    raise RuntimeError("The worker process (pid %d) running a target died" % (pid))
+
+    def finish(node):
+        # The node and all its descendants are done.
+        while node is not None:
+            if node.followOn is not None:
+                # The follow-on takes the node's place in its parent.
+                followOn = node.followOn
+                node.followOn = None
+                submit(followOn, node.parent)
+                return
+            node = node.parent
+            if node is None:
+                return
+            node.remainingChildren -= 1
+            if node.remainingChildren != 0:
+                return
+
+    try:
+        submit(rootTarget, None)
+        while len(running) != 0:
+            try:
+                targetId, result = finishedQueue.get(timeout=POLL_INTERVAL)
+            except Queue.Empty:
+                checkRunning()
+                continue
+            node, _ = running.pop(targetId)
+            os.remove(getPidPath(workDir, targetId))
+            if result[0] == 'error':
+                raise RuntimeError("Target failed:\n%s" % result[1])
+            _, children, followOn = result
+            node.followOn = followOn
+            node.remainingChildren = len(children)
+            for child in children:
+                submit(child, node)
+            if len(children) == 0:
+                finish(node)
+    finally:
+        pool.terminate()
+        pool.join()
+        if removeWorkDir:
+            shutil.rmtree(workDir, ignore_errors=True)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""Tests for localExecutor.py."""
+import os
+import shutil
+import tempfile
+import unittest
+
+from localExecutor import LocalTarget, runLocally
+
+class AppendTarget(LocalTarget):
+    """Appends its name to a file, then schedules its children and
+    follow-on."""
+    def __init__(self, path, name, children=None, followOn=None):
+        LocalTarget.__init__(self)
+        self.path = path
+        self.name = name
+        if children is None:
+            children = []
+        self.children = children
+        self.followOn = followOn
+
+    def run(self):
+        appendFile = open(self.path, 'a')
+        appendFile.write(self.name + "\n")
+        appendFile.close()
+        for child in self.children:
+            self.addChildTarget(child)
+        if self.followOn is not None:
+            self.setFollowOnTarget(self.followOn)
+
+class FailingTarget(LocalTarget):
+    def run(self):
+        raise ValueError("failed on purpose")
+
+class UnpicklableChildTarget(LocalTarget):
+    def run(self):
+        child = FailingTarget()
+        child.function = lambda: None
+        self.addChildTarget(child)
+
+class DyingTarget(LocalTarget):
+    def run(self):
+        os._exit(1)
+
+class LocalExecutorTest(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def testChildrenRunBeforeFollowOn(self):
+        path = os.path.join(self.tempDir, "order")
+        grandchildren = [AppendTarget(path, "grandchild%d" % i) for i in xrange(5)]
+        children = [AppendTarget(path, "child0", grandchildren),
+                    AppendTarget(path, "child1", followOn=AppendTarget(path, "child1FollowOn"))]
+        runLocally(AppendTarget(path, "root", children, AppendTarget(path, "rootFollowOn")), 3)
+        order = open(path).read().split()
+        self.assertEqual(len(order), 10)
+        self.assertEqual(order[0], "root")
+        self.assertEqual(order[-1], "rootFollowOn")
+        for i in xrange(5):
+            self.assertTrue(order.index("child0") < order.index("grandchild%d" % i))
+        self.assertTrue(order.index("child1") < order.index("child1FollowOn"))
+
+    def testFailingTarget(self):
+        with self.assertRaisesRegexp(RuntimeError, "failed on purpose"):
+            runLocally(AppendTarget(os.path.join(self.tempDir, "order"), "root", [FailingTarget()]), 2)
+
+    def testUnpicklableTarget(self):
+        # Raises the pickling error instead of waiting forever.
+        self.assertRaises(Exception, runLocally, UnpicklableChildTarget(), 2)
+
+    def testWorkerDies(self):
+        with self.assertRaisesRegexp(RuntimeError, "died"):
+            runLocally(DyingTarget(), 2)
+
+if __name__ == '__main__':
+    unittest.main()
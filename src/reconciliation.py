@@ -0,0 +1,430 @@
+#!/usr/bin/env python
+"""Reconcile a gene tree with respect to a species tree in-process,
+and, optionally, collapse duplication nodes to make a multifurcated
+tree. Gives the same labels and topology as src/reconcile.c, so that
+scoreHalPhylogenies.py (with --reconcileInProcess) doesn't need to
+spawn a process (and re-parse both trees) for every column;
+reconciliationTest.py compares the two.
+
+Branch lengths differ: when collapsing a unary node, reconcile.c drops
+its branch length and counts its child's twice (and treats missing
+lengths as infinite), whereas here the two lengths are summed.
+
+Usage: reconciliation.py gene2species geneTree speciesTree [collapseIdenticalNodes=0] [reRoot=0]"""
+import sys
+
+class TreeNode(object):
+    """A mutable node in a rooted tree. Missing labels are represented
+    by "" and missing branch lengths by None."""
+    __slots__ = ['label', 'branchLength', 'children', 'parent']
+
+    def __init__(self, label="", branchLength=None):
+        self.label = label
+        self.branchLength = branchLength
+        self.children = []
+        self.parent = None
+
+    def addChild(self, child):
+        child.parent = self
+        self.children.append(child)
+
+    def isLeaf(self):
+        return len(self.children) == 0
+
+def preOrder(root):
+    """Return a list of the nodes under root (inclusive) in pre-order."""
+    ret = []
+    stack = [root]
+    while len(stack) != 0:
+        node = stack.pop()
+        ret.append(node)
+        stack.extend(reversed(node.children))
+    return ret
+
+def postOrder(root):
+    """Return a list of the nodes under root (inclusive) in post-order."""
+    ret = []
+    stack = [(root, False)]
+    while len(stack) != 0:
+        node, childrenDone = stack.pop()
+        if childrenDone:
+            ret.append(node)
+        else:
+            stack.append((node, True))
+            stack.extend((child, False) for child in reversed(node.children))
+    return ret
+
+def parseNewick(newick):
+    """Parse a newick string into a tree of TreeNodes, returning the root."""
+    newick = newick.strip()
+    if newick.endswith(";"):
+        newick = newick[:-1]
+    root = TreeNode()
+    node = root
+    i = 0
+    while i < len(newick):
+        char = newick[i]
+        if char == '(':
+            child = TreeNode()
+            node.addChild(child)
+            node = child
+            i += 1
+        elif char == ',':
+            child = TreeNode()
+            node.parent.addChild(child)
+            node = child
+            i += 1
+        elif char == ')':
+            node = node.parent
+            i += 1
+        elif char.isspace():
+            i += 1
+        else:
+            # A label, branch length, or both.
+            end = i
+            while end < len(newick) and newick[end] not in '(),':
+                end += 1
+            token = newick[i:end].strip()
+            if ':' in token:
+                label, branchLength = token.rsplit(':', 1)
+                node.branchLength = float(branchLength)
+            else:
+                label = token
+            node.label = label
+            i = end
+    if node is not root:
+        raise RuntimeError("Unbalanced parentheses in newick string %s" % newick)
+    return root
+
+def writeNewick(root):
+    """Get a newick string for the tree under root."""
+    def nodeSuffix(node):
+        if node.branchLength is None:
+            return node.label
+        return "%s:%g" % (node.label, node.branchLength)
+    strings = {}
+    for node in postOrder(root):
+        if node.isLeaf():
+            strings[node] = nodeSuffix(node)
+        else:
+            strings[node] = "(%s)%s" % (",".join(strings.pop(child) for child in node.children),
+                                        nodeSuffix(node))
+    return strings[root] + ";"
+
+class NodeTree:
+    """Read-only view of a TreeNode tree that provides the subset of the
+    NXTree interface used by the scoring code. The node objects
+    themselves serve as the ids."""
+    def __init__(self, root):
+        self.root = root
+
+    def getRootId(self):
+        return self.root
+
+    def getChildren(self, id):
+        return id.children
+
+    def hasParent(self, id):
+        return id.parent is not None
+
+    def getParent(self, id):
+        return id.parent
+
+    def hasName(self, id):
+        return id.label != ""
+
+    def getName(self, id):
+        return id.label
+
+    def isLeaf(self, id):
+        return id.isLeaf()
+
+    def postOrderTraversal(self):
+        return postOrder(self.root)
+
+    def getNameToId(self):
+        """Get a mapping from name to id for all named nodes."""
+        return dict((node.label, node) for node in postOrder(self.root) if node.label != "")
+
+class SpeciesTreeIndex:
+    """Parent, depth and (cached) MRCA lookups by name on a species tree
+    with the NXTree interface. Will be invalid if changes are made to
+    the tree."""
+    def __init__(self, tree):
+        self.parent = {}
+        self.depth = {}
+        root = tree.getRootId()
+        self.depth[tree.getName(root)] = 0
+        stack = [root]
+        while len(stack) != 0:
+            node = stack.pop()
+            name = tree.getName(node)
+            for child in tree.getChildren(node):
+                childName = tree.getName(child)
+                self.parent[childName] = name
+                self.depth[childName] = self.depth[name] + 1
+                stack.append(child)
+        self.mrcaCache = {}
+
+    def mrca(self, name1, name2):
+        if name1 == name2:
+            return name1
+        key = (name1, name2)
+        if key in self.mrcaCache:
+            return self.mrcaCache[key]
+        while self.depth[name1] > self.depth[name2]:
+            name1 = self.parent[name1]
+        while self.depth[name2] > self.depth[name1]:
+            name2 = self.parent[name2]
+        while name1 != name2:
+            name1 = self.parent[name1]
+            name2 = self.parent[name2]
+        self.mrcaCache[key] = name1
+        return name1
+
+    def eventCost(self, species, childSpecies):
+        """Get the (duplications, losses) implied by a gene-tree node
+        reconciled to species whose children are reconciled to
+        childSpecies."""
+        isDuplication = species in childSpecies
+        losses = 0
+        for child in childSpecies:
+            losses += self.depth[child] - self.depth[species]
+            if not isDuplication:
+                losses -= 1
+        return (1 if isDuplication else 0), losses
+
+def addBranchLengths(branchLength1, branchLength2):
+    if branchLength1 is None:
+        return branchLength2
+    if branchLength2 is None:
+        return branchLength1
+    return branchLength1 + branchLength2
+
+def collapseUnnecessaryNodes(root):
+    """Collapse internal nodes that have a single child, returning the
+    new root. Necessary since reconciliation is binary-only and we
+    sometimes have a (somewhat sloppily-) induced tree with degree-2
+    nodes."""
+    while len(root.children) == 1:
+        child = root.children[0]
+        child.branchLength = addBranchLengths(child.branchLength, root.branchLength)
+        child.parent = None
+        root = child
+    stack = [root]
+    while len(stack) != 0:
+        node = stack.pop()
+        for i, child in enumerate(node.children):
+            while len(child.children) == 1:
+                grandchild = child.children[0]
+                grandchild.branchLength = addBranchLengths(grandchild.branchLength, child.branchLength)
+                child = grandchild
+            child.parent = node
+            node.children[i] = child
+        stack.extend(node.children)
+    return root
+
+def isBinaryTree(root):
+    return all(len(node.children) in (0, 2) for node in preOrder(root))
+
+def arbitrarilyBinarize(root):
+    """Binarize a tree that is at least binary (i.e. has at least 2
+    children for every internal node), the same way reconcile.c does."""
+    stack = [root]
+    while len(stack) != 0:
+        node = stack.pop()
+        assert len(node.children) != 1
+        for _ in xrange(len(node.children) - 2):
+            newNode = TreeNode(branchLength=0.0)
+            node.addChild(newNode)
+            for child in node.children[:2]:
+                newNode.addChild(child)
+            del node.children[:2]
+        stack.extend(node.children)
+
+def reconcile(root, speciesIndex, leafToSpecies, relabelAncestors):
+    """Map each node of a binary gene tree to the LCA of its leaves'
+    species. Returns a dict from node to (species, isDuplication)."""
+    ret = {}
+    for node in postOrder(root):
+        if node.isLeaf():
+            ret[node] = (leafToSpecies[node.label], False)
+            continue
+        childSpecies = [ret[child][0] for child in node.children]
+        species = childSpecies[0]
+        for other in childSpecies[1:]:
+            species = speciesIndex.mrca(species, other)
+        ret[node] = (species, species in childSpecies)
+        if relabelAncestors:
+            node.label = species
+    return ret
+
+def rootByReconciliation(root, speciesIndex, leafToSpecies):
+    """Reroot a binary gene tree on the branch that minimizes the number
+    of duplications, then losses, when reconciled. The new root is
+    placed halfway along that branch. All rootings are scored in linear
+    time by computing the reconciliation of both sides of every branch.
+    """
+    # Build the unrooted tree, suppressing the (degree-2) root.
+    neighbors = {}
+    edgeLengths = {}
+    def addEdge(node1, node2, length):
+        neighbors.setdefault(node1, []).append(node2)
+        neighbors.setdefault(node2, []).append(node1)
+        edgeLengths[(node1, node2)] = length
+        edgeLengths[(node2, node1)] = length
+    candidateEdges = []
+    for node in preOrder(root):
+        if node is root:
+            continue
+        if node.parent is root:
+            if len(root.children) == 2:
+                if node is root.children[1]:
+                    continue
+                other = root.children[1]
+                addEdge(node, other, addBranchLengths(node.branchLength, other.branchLength))
+                candidateEdges.append((node, other))
+                continue
+        addEdge(node, node.parent, node.branchLength)
+        candidateEdges.append((node, node.parent))
+    if len(candidateEdges) == 0:
+        # Single-node tree.
+        return root
+
+    # Reconciliation info (species, dups, losses) for the side of every
+    # branch (a, b) containing b, when the tree is rooted outside it.
+    sides = {}
+    def computeSide(a, b):
+        others = [c for c in neighbors[b] if c is not a]
+        if len(others) == 0:
+            sides[(a, b)] = (leafToSpecies[b.label], 0, 0)
+            return
+        childSides = [sides[(b, c)] for c in others]
+        childSpecies = [side[0] for side in childSides]
+        species = speciesIndex.mrca(childSpecies[0], childSpecies[1])
+        dups, losses = speciesIndex.eventCost(species, childSpecies)
+        for side in childSides:
+            dups += side[1]
+            losses += side[2]
+        sides[(a, b)] = (species, dups, losses)
+
+    # Two passes over the unrooted tree: first the sides pointing
+    # away from an arbitrary start node, then the sides pointing
+    # toward it.
+    start = candidateEdges[0][0]
+    order = []
+    parentOf = {start: None}
+    stack = [start]
+    while len(stack) != 0:
+        node = stack.pop()
+        order.append(node)
+        for neighbor in neighbors[node]:
+            if neighbor is not parentOf[node]:
+                parentOf[neighbor] = node
+                stack.append(neighbor)
+    for node in reversed(order):
+        if parentOf[node] is not None:
+            computeSide(parentOf[node], node)
+    for node in order:
+        if parentOf[node] is not None:
+            computeSide(node, parentOf[node])
+
+    bestEdge = None
+    bestCost = None
+    for node1, node2 in candidateEdges:
+        side1 = sides[(node2, node1)]
+        side2 = sides[(node1, node2)]
+        species = speciesIndex.mrca(side1[0], side2[0])
+        dups, losses = speciesIndex.eventCost(species, [side1[0], side2[0]])
+        cost = (dups + side1[1] + side2[1], losses + side1[2] + side2[2])
+        if bestCost is None or cost < bestCost:
+            bestEdge = (node1, node2)
+            bestCost = cost
+
+    # Build the rerooted tree out of new nodes.
+    newRoot = TreeNode()
+    length = edgeLengths[bestEdge]
+    halfLength = None if length is None else length / 2
+    stack = []
+    for node, awayFrom in (bestEdge, reversed(bestEdge)):
+        newNode = TreeNode(node.label, halfLength)
+        newRoot.addChild(newNode)
+        stack.append((node, awayFrom, newNode))
+    while len(stack) != 0:
+        node, awayFrom, newNode = stack.pop()
+        for neighbor in neighbors[node]:
+            if neighbor is awayFrom:
+                continue
+            newChild = TreeNode(neighbor.label, edgeLengths[(node, neighbor)])
+            newNode.addChild(newChild)
+            stack.append((neighbor, node, newChild))
+    return newRoot
+
+def relabelDupNodes(root, reconciliation, speciesIndex):
+    """To compare properly against HAL, nodes reconciled to branches
+    should be reconciled to the parent genome."""
+    for node in preOrder(root):
+        species, isDuplication = reconciliation[node]
+        if isDuplication and species in speciesIndex.parent:
+            node.label = speciesIndex.parent[species]
+
+def collapseIdenticalAncestors(root):
+    """Collapse internal nodes if they and their parent have the same
+    name. Like reconcile.c, this also removes all branch lengths."""
+    for node in postOrder(root):
+        node.branchLength = None
+        newChildren = []
+        for child in node.children:
+            if child.label == node.label and not child.isLeaf():
+                for grandchild in child.children:
+                    grandchild.parent = node
+                newChildren.extend(child.children)
+            else:
+                newChildren.append(child)
+        node.children = newChildren
+
+def reconcileGeneTree(geneTree, speciesIndex, leafToSpecies,
+                      collapseIdenticalNodes=False, reRoot=False):
+    """Reconcile a gene tree (a root TreeNode, which may be modified)
+    against the species tree in speciesIndex, labeling the ancestors
+    with their species. leafToSpecies maps leaf labels to species
+    names. Returns the root of the reconciled tree.
+    """
+    geneTree = collapseUnnecessaryNodes(geneTree)
+    if not isBinaryTree(geneTree):
+        sys.stderr.write("WARNING: arbitrarily binarizing multifurcated tree. This is "
+                         "fine if you are rerooting a trifurcated (unrooted) tree, but is bad "
+                         "otherwise.\n")
+        arbitrarilyBinarize(geneTree)
+        assert isBinaryTree(geneTree)
+
+    if reRoot:
+        geneTree = rootByReconciliation(geneTree, speciesIndex, leafToSpecies)
+
+    # relabel the ancestors.
+    reconciliation = reconcile(geneTree, speciesIndex, leafToSpecies, True)
+
+    relabelDupNodes(geneTree, reconciliation, speciesIndex)
+
+    if collapseIdenticalNodes:
+        collapseIdenticalAncestors(geneTree)
+    return geneTree
+
+if __name__ == '__main__':
+    # Same interface as the reconcile binary, for comparing the two.
+    if len(sys.argv) < 4:
+        print __doc__
+        sys.exit(1)
+    leafToSpecies = {}
+    for line in open(sys.argv[1]):
+        fields = line.split()
+        if len(fields) == 0:
+            continue
+        assert len(fields) == 2
+        leafToSpecies[fields[0]] = fields[1]
+    speciesIndex = SpeciesTreeIndex(NodeTree(parseNewick(sys.argv[3])))
+    collapseIdenticalNodes = len(sys.argv) > 4 and int(sys.argv[4]) != 0
+    reRoot = len(sys.argv) > 5 and int(sys.argv[5]) != 0
+    reconciled = reconcileGeneTree(parseNewick(sys.argv[2]), speciesIndex, leafToSpecies,
+                                   collapseIdenticalNodes, reRoot)
+    print writeNewick(reconciled)
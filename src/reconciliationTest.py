@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""Tests for reconciliation.py, mostly checking that it gives the same
+trees as the reconcile binary (src/reconcile.c), apart from branch
+lengths."""
+import os
+import subprocess
+import tempfile
+import unittest
+
+from reconciliation import parseNewick, writeNewick, postOrder, NodeTree, SpeciesTreeIndex, reconcileGeneTree
+
+def findReconcileBinary():
+    """Get the path to the reconcile binary (bin/reconcile, or on the
+    PATH), or None if it hasn't been built."""
+    builtPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin", "reconcile")
+    if os.access(builtPath, os.X_OK):
+        return builtPath
+    for directory in os.environ.get("PATH", "").split(os.pathsep):
+        path = os.path.join(directory, "reconcile")
+        if os.access(path, os.X_OK):
+            return path
+    return None
+
+RECONCILE_BINARY = findReconcileBinary()
+
+SPECIES_TREE = "(((h,c)hc,g)hcg,o)hcgo;"
+
+# Gene trees, named by what they exercise. Leaves are named after their
+# species, then a number.
+GENE_TREES = [
+    ("binary", "(((h1,c1),g1),o1);"),
+    ("branchLengths", "(((h1:0.1,c1:0.2):0.3,g1:0.4):0.5,o1:0.6);"),
+    ("trifurcatedRoot", "((h1:1,c1:1):1,g1:2,o1:3);"),
+    ("multifurcation", "((h1,c1,g1,h2),o1);"),
+    ("unaryNodes", "((((h1:1):2,c1:3)),((g1:1)):1,o1:4);"),
+    ("unaryRoot", "((((h1,c1),g1),o1));"),
+    ("duplicationAtRoot", "((h1,c1),(h2,c2));"),
+    ("duplicationAtRootAboveOutgroup", "(((h1,c1),g1,o1),((h2,c2),g2,o2));"),
+    ("duplicationBelowRoot", "((((h1,c1),(h2,c2)),g1),o1);"),
+    # Every rooting of these unrooted trees has the same number of
+    # duplications, or the same duplications and losses.
+    ("tiedRoots", "(h1,h2,h3);"),
+    ("tiedRootsWithLosses", "((h1,g1),(c1,g2),o1);"),
+    ("misrooted", "((h1,c1),(g1,o1));"),
+    ("discordant", "((h1,o1),(c1,g1));"),
+]
+
+def canonicalNewick(newick):
+    """Get a newick string for the labels and topology of a tree, that
+    doesn't depend on the order of children. Branch lengths are left
+    out: reconcile.c gets them wrong when collapsing unary nodes (see
+    reconciliation.py), and they don't affect the scoring."""
+    strings = {}
+    root = parseNewick(newick)
+    for node in postOrder(root):
+        if node.isLeaf():
+            strings[node] = node.label
+        else:
+            strings[node] = "(%s)%s" % (",".join(sorted(strings.pop(child) for child in node.children)), node.label)
+    return strings[root] + ";"
+
+def reconcileInProcess(geneNewick, collapseIdenticalNodes, reRoot):
+    leafToSpecies = dict((leaf.label, leaf.label[0]) for leaf in postOrder(parseNewick(geneNewick)) if leaf.isLeaf())
+    speciesIndex = SpeciesTreeIndex(NodeTree(parseNewick(SPECIES_TREE)))
+    return writeNewick(reconcileGeneTree(parseNewick(geneNewick), speciesIndex, leafToSpecies,
+                                         collapseIdenticalNodes, reRoot))
+
+def reconcileWithBinary(geneNewick, collapseIdenticalNodes, reRoot):
+    gene2species = tempfile.NamedTemporaryFile()
+    for leaf in postOrder(parseNewick(geneNewick)):
+        if leaf.isLeaf():
+            gene2species.write("%s\t%s\n" % (leaf.label, leaf.label[0]))
+    gene2species.flush()
+    output = subprocess.check_output([RECONCILE_BINARY, gene2species.name, geneNewick, SPECIES_TREE,
+                                      str(int(collapseIdenticalNodes)), str(int(reRoot))],
+                                     stderr=open(os.devnull, 'w'))
+    gene2species.close()
+    return output.strip()
+
+class ReconciliationTest(unittest.TestCase):
+    def testReconcile(self):
+        self.assertEqual(reconcileInProcess("(((h1,c1),g1),o1);", False, False),
+                         "(((h1,c1)hc,g1)hcg,o1)hcgo;")
+
+    def testDuplicationsLabeledWithParentSpecies(self):
+        self.assertEqual(reconcileInProcess("((h1,c1),(h2,c2));", False, False),
+                         "((h1,c1)hc,(h2,c2)hc)hcg;")
+        self.assertEqual(reconcileInProcess("(h1,h2);", False, False), "(h1,h2)hc;")
+        # There's no parent for the root species to relabel it with.
+        self.assertEqual(reconcileInProcess("((h1,o1),(c1,o2));", False, False),
+                         "((h1,o1)hcgo,(c1,o2)hcgo)hcgo;")
+
+    def testCollapseUnaryNodes(self):
+        # The collapsed nodes' branch lengths are added to their
+        # children's. (reconcile.c would give h1:2, not h1:3.)
+        self.assertEqual(reconcileInProcess("((((h1:1):2,c1:3)):1,g1:4):5;", False, False),
+                         "((h1:3,c1:3)hc:1,g1:4)hcg:5;")
+
+    def testBinarize(self):
+        self.assertEqual(reconcileInProcess("(h1,c1,g1,o1);", False, False),
+                         "((h1,c1)hc:0,(g1,o1)hcgo:0)hcgo;")
+
+    def testReRoot(self):
+        self.assertEqual(canonicalNewick(reconcileInProcess("((h1,c1),(g1,o1));", False, True)),
+                         canonicalNewick("(o1,((h1,c1)hc,g1)hcg)hcgo;"))
+
+    def testCollapseIdenticalNodes(self):
+        self.assertEqual(reconcileInProcess("(((h1,c1),(h2,c2)),g1);", True, False),
+                         "((h1,c1)hc,(h2,c2)hc,g1)hcg;")
+
+    @unittest.skipIf(RECONCILE_BINARY is None, "the reconcile binary hasn't been built")
+    def testSameAsBinary(self):
+        for name, geneNewick in GENE_TREES:
+            for collapseIdenticalNodes in (False, True):
+                for reRoot in (False, True):
+                    expected = reconcileWithBinary(geneNewick, collapseIdenticalNodes, reRoot)
+                    actual = reconcileInProcess(geneNewick, collapseIdenticalNodes, reRoot)
+                    self.assertEqual(canonicalNewick(actual), canonicalNewick(expected),
+                                     "%s (collapse=%s, reRoot=%s): got %s, but reconcile gave %s"
+                                     % (name, collapseIdenticalNodes, reRoot, actual, expected))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,98 +3,265 @@
 extracting surrounding sequence, realigning, and finally comparing
 independently estimated trees vs. the induced trees from the HAL."""
 from argparse import ArgumentParser
-from jobTree.scriptTree.target import Target
-from jobTree.scriptTree.stack import Stack
-from sonLib.bioio import system, getTempFile, popenCatch
-from sonLib.nxnewick import NXNewick
-from collections import namedtuple, defaultdict, Counter
+try:
+    from jobTree.scriptTree.target import Target
+    from jobTree.scriptTree.stack import Stack
+except ImportError:
+    # jobTree is only needed for cluster runs; --local runs don't use it.
+    from localExecutor import LocalTarget as Target
+    Stack = None
+from sonLib.bioio import getTempFile, popenCatch
+from columnCache import ColumnCache, getFileDigest
+from compactTree import parseCompactNewick
+from localExecutor import runLocally
+from reconciliation import parseNewick, writeNewick, NodeTree, SpeciesTreeIndex, reconcileGeneTree
+from collections import namedtuple, Counter
+from array import array
+import bisect
+import copy
+import errno
+import hashlib
+import heapq
 import math
+import mmap
+import os
 import random
+import Queue
+import struct
+import subprocess
 import sys
+import threading
+import time
 
 Coalescence = namedtuple('Coalescence', ['genome1', 'seq1', 'pos1', 'genome2', 'seq2', 'pos2', 'mrca'])
 
+def getCompactMRCA(tree, id1, id2):
+    """Return the MRCA of two nodes in a CompactTree. Takes time
+    proportional to the depth of the MRCA below id1, with no
+    precomputation, so is cheaper than an LCAIndex for a few queries
+    on a small tree."""
+    while not tree.isAncestor(id1, id2):
+        id1 = tree.parents[id1]
+    return id1
+
 def getMRCA(tree, id1, id2):
-    """Return the MRCA of two nodes in an NXTree."""
-    candidates1 = set([id1])
-    curNode = id1
-    while tree.hasParent(curNode):
-        curNode = tree.getParent(curNode)
-        candidates1.add(curNode)
-    curNode = id2
-    if curNode in candidates1:
-        return curNode
-    while tree.hasParent(curNode):
-        curNode = tree.getParent(curNode)
-        if curNode in candidates1:
-            return curNode
-    raise RuntimeError("No MRCA found for nodes %d and %d" % (id1, id2))
-
-def getNameToIdDict(tree):
-    """Get a mapping from name to id for an nxtree. Will be invalid if
-    changes are made to the tree.
+    """Return the MRCA of two nodes in any tree with parent links (a
+    CompactTree or NodeTree), by walking up to the root. Like
+    getCompactMRCA, cheaper than an LCAIndex for a few queries."""
+    ancestors = set([id1])
+    while tree.hasParent(id1):
+        id1 = tree.getParent(id1)
+        ancestors.add(id1)
+    while id2 not in ancestors:
+        id2 = tree.getParent(id2)
+    return id2
+
+class LCAIndex:
+    """Answers MRCA queries on a tree (a CompactTree or NodeTree) in
+    constant time after an O(n log n) precomputation: an Euler tour of
+    the tree, plus a sparse table of the shallowest tour entry in every
+    power-of-two-sized window. Will be invalid if changes are made to
+    the tree.
     """
-    ret = {}
-    for id in tree.postOrderTraversal():
-        if tree.hasName(id):
-            ret[tree.getName(id)] = id
-    return ret
+    def __init__(self, tree):
+        # Nodes in Euler-tour order, their depths, and the index of
+        # each node's first appearance in the tour.
+        self.tour = []
+        self.depths = []
+        self.firstVisit = {}
+        root = tree.getRootId()
+        self.visit(root, 0)
+        stack = [(root, 0, iter(tree.getChildren(root)))]
+        while len(stack) != 0:
+            node, depth, children = stack[-1]
+            child = next(children, None)
+            if child is None:
+                stack.pop()
+                if len(stack) != 0:
+                    self.visit(stack[-1][0], stack[-1][1])
+            else:
+                self.visit(child, depth + 1)
+                stack.append((child, depth + 1, iter(tree.getChildren(child))))
 
-def getLeafNames(tree):
-    ret = []
-    for id in tree.postOrderTraversal():
-        if tree.hasName(id) and len(tree.getChildren(id)) == 0:
-            ret.append(tree.getName(id))
-    return ret
+        # sparseTable[k][i] is the tour index of the shallowest node
+        # in tour[i:i + 2**k].
+        depths = self.depths
+        self.sparseTable = [range(len(self.tour))]
+        k = 1
+        while (1 << k) <= len(self.tour):
+            prev = self.sparseTable[-1]
+            halfWidth = 1 << (k - 1)
+            row = []
+            for i in xrange(len(self.tour) - (1 << k) + 1):
+                left = prev[i]
+                right = prev[i + halfWidth]
+                row.append(left if depths[left] <= depths[right] else right)
+            self.sparseTable.append(row)
+            k += 1
+
+    def visit(self, node, depth):
+        if node not in self.firstVisit:
+            self.firstVisit[node] = len(self.tour)
+        self.tour.append(node)
+        self.depths.append(depth)
+
+    def mrca(self, id1, id2):
+        """Return the MRCA of two nodes in the indexed tree."""
+        start = self.firstVisit[id1]
+        end = self.firstVisit[id2]
+        if start > end:
+            start, end = end, start
+        k = (end - start + 1).bit_length() - 1
+        left = self.sparseTable[k][start]
+        right = self.sparseTable[k][end - (1 << k) + 1]
+        if self.depths[left] <= self.depths[right]:
+            return self.tour[left]
+        return self.tour[right]
+
+class SpeciesTree:
+    """A parsed species tree with a name index and an LCA index, built
+    once per job. Only the newick string is pickled (the indices are
+    rebuilt on unpickling), so it is cheap to hand to child targets.
+    Should be treated as immutable.
+    """
+    def __init__(self, newick):
+        self.newick = newick
+        self.tree = parseCompactNewick(newick)
+        self.nameToId = self.tree.getNameToId()
+        self.lcaIndex = LCAIndex(self.tree)
+        self.reconciliationIndex = SpeciesTreeIndex(self.tree)
+        # Genomes are interned to small integer ids in the coalescence
+        # records.
+        self.genomes = sorted(self.nameToId.keys())
+        self.genomeIds = dict((genome, i) for i, genome in enumerate(self.genomes))
+        # (hal MRCA name, reconciled MRCA name) -> comparison result
+        self.comparisonCache = {}
+        self.outcomeTable = None
+
+    def __getstate__(self):
+        return self.newick
+
+    def __setstate__(self, newick):
+        self.__init__(newick)
+
+    def compareMRCAs(self, halMrca, reconciledMrca):
+        """Return "identical", "late" (the hal MRCA is an ancestor of
+        the reconciled MRCA), or "early" (the hal MRCA is a descendant
+        of the reconciled MRCA)."""
+        key = (halMrca, reconciledMrca)
+        if key in self.comparisonCache:
+            return self.comparisonCache[key]
+        assert halMrca in self.nameToId
+        reconciledId = self.nameToId[reconciledMrca]
+        halId = self.nameToId[halMrca]
+        id = self.lcaIndex.mrca(halId, reconciledId)
+        assert id == halId or id == reconciledId
+        if reconciledId == halId:
+            result = "identical"
+        elif id == halId:
+            # Late in hal relative to independent estimate
+            result = "late"
+        else:
+            # Early in hal relative to independent estimate
+            result = "early"
+        self.comparisonCache[key] = result
+        return result
+
+    def getOutcomeTable(self):
+        """Get the OUTCOMES index of compareMRCAs for every pair of
+        species at once, as a flat list indexed by (hal MRCA id) *
+        len(genomes) + (reconciled MRCA id), where ids index genomes.
+        Entries for species where neither is an ancestor of the other
+        are None."""
+        if self.outcomeTable is None:
+            numSpecies = len(self.genomes)
+            self.outcomeTable = [None] * (numSpecies * numSpecies)
+            for halId, halMrca in enumerate(self.genomes):
+                for reconciledId, reconciledMrca in enumerate(self.genomes):
+                    id = self.lcaIndex.mrca(self.nameToId[halMrca], self.nameToId[reconciledMrca])
+                    if id == self.nameToId[halMrca] or id == self.nameToId[reconciledMrca]:
+                        result = self.compareMRCAs(halMrca, reconciledMrca)
+                        self.outcomeTable[halId * numSpecies + reconciledId] = OUTCOMES.index(result)
+        return self.outcomeTable
 
 ColumnEntry = namedtuple('ColumnEntry', ['genome', 'seq', 'pos'])
 
 def parseColumnEntryFromString(s):
     """Gets a ColumnEntry struct from a leaf name in a tree."""
-    return ColumnEntry(genome=s.split("|")[0].split(".")[0],
-                       seq=".".join(s.split("|")[0].split(".")[1:]),
-                       pos=int(s.split("|")[1]))
+    fields = s.split("|")
+    genome, _, seq = fields[0].partition(".")
+    return ColumnEntry(genome=genome, seq=seq, pos=int(fields[1]))
 
-def sampleCoalescences(tree, maxCoalescences, sampleNonDuplicates, requiredPosition=None):
-    def choose(n, k):
-        return math.factorial(n) / (math.factorial(k) * math.factorial(n - k))
-    nameToId = getNameToIdDict(tree)
-    validNames = getLeafNames(tree)
+def getColumnLeaves(tree):
+    """Get the (name, ColumnEntry) of every leaf in a column's
+    CompactTree, in left-to-right order."""
+    # Relies on the sequences being named by
+    # getRegionAroundSampledColumn, i.e. genome.seq|pos
+    return [(name, parseColumnEntryFromString(name)) for name in tree.getLeafNames()]
+
+def unrankPair(rank):
+    """Get the rank'th (i, j) pair, i < j, in the colexicographic order
+    (0, 1), (0, 2), (1, 2), (0, 3), ..."""
+    j = int((1 + math.sqrt(1 + 8 * rank)) / 2)
+    # Correct for any floating-point error in the square root.
+    while j * (j - 1) / 2 > rank:
+        j -= 1
+    while (j + 1) * j / 2 <= rank:
+        j += 1
+    return (rank - j * (j - 1) / 2, j)
+
+def samplePairs(items, maxPairs):
+    """Sample min(maxPairs, n choose 2) distinct unordered pairs
+    uniformly from a list of n items, without rejection."""
+    numPairs = len(items) * (len(items) - 1) / 2
+    ranks = random.sample(xrange(numPairs), min(maxPairs, numPairs))
+    pairs = []
+    for rank in ranks:
+        i, j = unrankPair(rank)
+        pairs.append((items[i], items[j]))
+    return pairs
 
+def getEligibleLeaves(leaves, sampleNonDuplicates):
+    """Get the (name, ColumnEntry) leaves of a column that can be part
+    of a coalescence pair."""
     # Find all duplicated genomes in a column
-    numGenomeAppearances = Counter(parseColumnEntryFromString(i).genome for i in validNames)
+    numGenomeAppearances = Counter(entry.genome for _, entry in leaves)
     duplicatedGenomes = set(k for k, v in numGenomeAppearances.items() if v > 1)
 
-    # Sample up to maxCoalescences pairs. This could be very slow if
-    # maxCoalescences is high.
-    pairs = set()
-    visited = set()
+    # Only leaves from duplicated genomes can be part of a pair,
+    # unless we're also sampling non-duplicated pairs.
+    if sampleNonDuplicates:
+        return leaves
+    return [leaf for leaf in leaves if leaf[1].genome in duplicatedGenomes]
+
+def sampleCoalescences(tree, maxCoalescences, sampleNonDuplicates, requiredPosition=None):
+    """Sample coalescences from a column's CompactTree."""
+    nameToId = tree.getNameToId()
+    leaves = getColumnLeaves(tree)
+
+    eligibleLeaves = getEligibleLeaves(leaves, sampleNonDuplicates)
+
+    # Sample up to maxCoalescences distinct pairs directly from the
+    # space of eligible pairs.
     if requiredPosition is None:
-        numPairs = choose(len(validNames), 2)
+        pairs = samplePairs(eligibleLeaves, maxCoalescences)
     else:
-        numPairs = len(validNames) - 1
-    numSamples = 0
-    while numSamples < maxCoalescences and len(visited) != numPairs:
-        pair = random.sample(validNames, 2)
-        if requiredPosition is not None and pair[1] != "%s.%s|%s" % requiredPosition:
-            pair[0] = "%s.%s|%s" % requiredPosition
-        pair.sort()
-        pair = (pair[0], pair[1])
-        visited.add(pair)
-        duplicated = parseColumnEntryFromString(pair[0]).genome in duplicatedGenomes \
-                     and parseColumnEntryFromString(pair[1]).genome in duplicatedGenomes
-        if pair not in pairs and (sampleNonDuplicates or duplicated):
-            pairs.add(pair)
-            numSamples += 1
+        requiredName = "%s.%s|%s" % requiredPosition
+        requiredLeaves = [leaf for leaf in eligibleLeaves if leaf[0] == requiredName]
+        others = [leaf for leaf in eligibleLeaves if leaf[0] != requiredName]
+        if len(requiredLeaves) == 0:
+            pairs = []
+        else:
+            pairs = [(requiredLeaves[0], leaf) for leaf in random.sample(others, min(maxCoalescences, len(others)))]
 
     # Create coalescences out of the pairs
     coalescences = []
-    for pair in pairs:
-        mrca = tree.getName(getMRCA(tree, nameToId[pair[0]], nameToId[pair[1]]))
-        # Relies on the sequences being named by
-        # getRegionAroundSampledColumn, i.e. genome.seq|pos
-        entry1 = parseColumnEntryFromString(pair[0])
-        entry2 = parseColumnEntryFromString(pair[1])
+    for leaf1, leaf2 in pairs:
+        if leaf2[0] < leaf1[0]:
+            leaf1, leaf2 = leaf2, leaf1
+        mrca = tree.getName(getCompactMRCA(tree, nameToId[leaf1[0]], nameToId[leaf2[0]]))
+        entry1 = leaf1[1]
+        entry2 = leaf2[1]
         coalescence = Coalescence(genome1=entry1.genome, seq1=entry1.seq,
                                   pos1=entry1.pos,
                                   genome2=entry2.genome, seq2=entry2.seq,
@@ -106,7 +273,7 @@ def sampleCoalescences(tree, maxCoalescences, sampleNonDuplicates, requiredPosit
 def matchCoalescences(tree, inputCoalescences):
     """Find coalescences whose underlying pairs match the coalescences
     provided."""
-    nameToId = getNameToIdDict(tree)
+    nameToId = tree.getNameToId()
     coalescences = []
     for coalescence in inputCoalescences:
         # Relies on the sequences being named by
@@ -122,6 +289,39 @@ def matchCoalescences(tree, inputCoalescences):
         coalescences.append(coalescence)
     return coalescences
 
+def getPairMrcaSpecies(tree, leafIndices, speciesIds, getSpecies):
+    """Get the species of the MRCA of every pair of leaves i < j, where
+    leafIndices maps the names of the leaves of interest to 0..n-1.
+    Returns a flat array indexed by i * n + j, holding speciesIds of
+    getSpecies(MRCA name). Takes time proportional to the number of
+    pairs, rather than doing an LCA query for each."""
+    numLeaves = len(leafIndices)
+    mrcas = array('i', [-1]) * (numLeaves * numLeaves)
+    # Indices of the leaves of interest under each node whose parent
+    # hasn't been visited yet.
+    leavesBelow = {}
+    for id in tree.postOrderTraversal():
+        children = tree.getChildren(id)
+        if len(children) == 0:
+            name = tree.getName(id) if tree.hasName(id) else None
+            leavesBelow[id] = [leafIndices[name]] if name in leafIndices else []
+            continue
+        # Every pair split between two of this node's children has
+        # this node as its MRCA.
+        species = speciesIds[getSpecies(tree.getName(id))]
+        below = []
+        for child in children:
+            childLeaves = leavesBelow.pop(child)
+            for i in below:
+                for j in childLeaves:
+                    if i < j:
+                        mrcas[i * numLeaves + j] = species
+                    else:
+                        mrcas[j * numLeaves + i] = species
+            below.extend(childLeaves)
+        leavesBelow[id] = below
+    return mrcas
+
 def getChromSizes(halPath, genome):
     """Get a dictionary of (chrom name):(chrom size) from a hal file."""
     output = popenCatch("halStats --chromSizes %s %s" % (genome, halPath))
@@ -133,51 +333,983 @@ def getChromSizes(halPath, genome):
         ret[fields[0]] = int(fields[1])
     return ret
 
-def samplePosition(chromSizes):
-    """Get a random (sequence, position) pair from a chromSizes dict. Very
-    inefficient, but it shouldn't matter much.
+class PositionSampler:
+    """Samples (sequence, position) pairs uniformly from a list of
+    (sequence, start, end) regions. Builds an array of cumulative region
+    ends once, so that each draw is a bisection rather than a scan
+    over every sequence."""
+    def __init__(self, regions):
+        self.regions = regions
+        self.cumulativeEnds = []
+        total = 0
+        for _, start, end in regions:
+            total += end - start
+            self.cumulativeEnds.append(total)
+        self.totalSize = total
+
+    def samplePosition(self):
+        """Get a random (sequence, position) pair."""
+        genomePos = random.randint(0, self.totalSize - 1)
+        i = bisect.bisect_right(self.cumulativeEnds, genomePos)
+        seq, start, end = self.regions[i]
+        return (seq, end - (self.cumulativeEnds[i] - genomePos))
+
+    def sampleUniquePositions(self, numSamples):
+        """Make numSamples draws, returning the distinct positions in
+        the order they were first drawn."""
+        positions = []
+        positionSet = set()
+        for _ in xrange(numSamples):
+            pos = self.samplePosition()
+            if pos not in positionSet:
+                positions.append(pos)
+                positionSet.add(pos)
+        return positions
+
+class PositionIndex:
+    """A sorted, memory-mapped set of (sequence, position) pairs, written
+    once to a shared directory and queried by binary search. Only the
+    path is pickled, so it costs the same to hand to a job however many
+    positions it holds.
+
+    The index file holds one native-endian (sequence id, position)
+    pair of unsigned 32-bit ints per position, sorted, and the sequence
+    names (indexed by id) are in a ".names" file next to it."""
+    RECORD = struct.Struct('=II')
+
+    def __init__(self, path):
+        self.path = path
+        self.mmap = None
+
+    @staticmethod
+    def write(positions, path):
+        """Write an index of the given positions to path, returning it."""
+        seqNames = sorted(set(seq for seq, _ in positions))
+        seqIds = dict((seq, i) for i, seq in enumerate(seqNames))
+        records = sorted(set((seqIds[seq], pos) for seq, pos in positions))
+        indexFile = open(path, 'wb')
+        for record in records:
+            indexFile.write(PositionIndex.RECORD.pack(*record))
+        indexFile.close()
+        namesFile = open(path + ".names", 'w')
+        for seq in seqNames:
+            namesFile.write(seq + "\n")
+        namesFile.close()
+        return PositionIndex(path)
+
+    def __getstate__(self):
+        return self.path
+
+    def __setstate__(self, path):
+        self.__init__(path)
+
+    def open(self):
+        self.seqIds = dict((line.rstrip("\n"), i) for i, line in enumerate(open(self.path + ".names")))
+        indexFile = open(self.path, 'rb')
+        size = os.fstat(indexFile.fileno()).st_size
+        self.numRecords = size / self.RECORD.size
+        # Set last, since it marks the index as open to other threads.
+        # (mmap can't map an empty file.)
+        self.mmap = mmap.mmap(indexFile.fileno(), 0, access=mmap.ACCESS_READ) if size != 0 else ""
+        indexFile.close()
+
+    def __len__(self):
+        if self.mmap is None:
+            self.open()
+        return self.numRecords
+
+    def __contains__(self, position):
+        if self.mmap is None:
+            self.open()
+        seq, pos = position
+        if seq not in self.seqIds:
+            return False
+        target = (self.seqIds[seq], pos)
+        low = 0
+        high = self.numRecords
+        while low < high:
+            mid = (low + high) / 2
+            if self.RECORD.unpack_from(self.mmap, mid * self.RECORD.size) < target:
+                low = mid + 1
+            else:
+                high = mid
+        return low < self.numRecords and self.RECORD.unpack_from(self.mmap, low * self.RECORD.size) == target
+
+def getRegionsFromChromSizes(chromSizes):
+    return [(seq, 0, size) for seq, size in chromSizes.items()]
+
+def getRegionsFromBed(bedPath, chromSizes):
+    """Get (sequence, start, end) regions from a BED file, clipped to
+    the sequences in chromSizes. Overlapping regions are kept, so
+    positions covered by several regions are sampled proportionally
+    more often. Raises a RuntimeError if no region overlaps the
+    sequences, since there would be nothing to sample."""
+    regions = []
+    for line in open(bedPath):
+        if line.startswith("#") or line.startswith("track") or line.startswith("browser"):
+            continue
+        fields = line.split()
+        if len(fields) < 3 or fields[0] not in chromSizes:
+            continue
+        start = max(int(fields[1]), 0)
+        end = min(int(fields[2]), chromSizes[fields[0]])
+        if end > start:
+            regions.append((fields[0], start, end))
+    if len(regions) == 0:
+        raise RuntimeError("No region in %s overlaps the reference genome's sequences" % (bedPath))
+    return regions
+
+# CPU time (user + system, in seconds) and peak RSS (in KB) of a child
+# process, including any processes it waited for.
+ProcessUsage = namedtuple('ProcessUsage', ['cpuTime', 'maxRSS'])
+
+def waitForProcess(process):
+    """Wait for a Popen process to exit, returning its ProcessUsage. The
+    exit status is set in process.returncode as usual."""
+    _, status, usage = os.wait4(process.pid, 0)
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    return ProcessUsage(usage.ru_utime + usage.ru_stime, usage.ru_maxrss)
+
+def extractColumns(halFile, refGenome, positions, width, positionsPath, usages=None):
+    """Generate (position, fasta) pairs for each (sequence, position) in
+    positions, in order. The columns are all extracted by a single
+    getRegionAroundSampledColumn process, so the hal file is only
+    opened once. Each fasta begins with a '#'-prefixed newick line
+    containing the column's tree, exactly as in the single-column
+    output. The ProcessUsage of the extraction is appended to the list
+    usages (if given) once it finishes.
+    """
+    writePositionsFile(positions, positionsPath)
+    process = subprocess.Popen(["getRegionAroundSampledColumn", halFile, refGenome,
+                                "--positionsFile", positionsPath,
+                                "--width", str(width)],
+                               stdout=subprocess.PIPE, bufsize=-1)
+    positionIter = iter(positions)
+    curLines = []
+    # Every column's output begins with the tree comment line, so
+    # that's where we split the stream.
+    for line in process.stdout:
+        if line[0] == '#' and len(curLines) != 0:
+            yield positionIter.next(), "".join(curLines)
+            curLines = []
+        curLines.append(line)
+    if len(curLines) != 0:
+        yield positionIter.next(), "".join(curLines)
+    process.stdout.close()
+    usage = waitForProcess(process)
+    if process.returncode != 0:
+        raise RuntimeError("getRegionAroundSampledColumn exited with status %d" % process.returncode)
+    if usages is not None:
+        usages.append(usage)
+
+def runPipedCommand(command, inputString, tempDir, usages=None):
+    """Run a shell command on inputString and return its output.
+
+    If the command contains "INPUT", the input is written to a
+    temporary file in tempDir whose path replaces "INPUT"; otherwise
+    the input is piped to the command's stdin. Likewise, if it
+    contains "OUTPUT", the output is read back from a temporary file;
+    otherwise it is read from the command's stdout. Any temporary files
+    are removed before returning. The command's ProcessUsage is
+    appended to the list usages, if given.
     """
-    genomeSize = sum(chromSizes.values()) # could pull this outside the function easily
-    genomePos = random.randint(0, genomeSize - 1)
-    curSize = 0
-    for seq, size in chromSizes.items():
-        if genomePos < curSize + size:
-            return (seq, genomePos - curSize)
-        curSize += size
-    assert False
+    tempPaths = []
+    try:
+        if "INPUT" in command:
+            inputPath = getTempFile(rootDir=tempDir)
+            tempPaths.append(inputPath)
+            inputHandle = open(inputPath, 'w')
+            inputHandle.write(inputString)
+            inputHandle.close()
+            command = command.replace("INPUT", inputPath)
+            inputString = None
+        outputPath = None
+        if "OUTPUT" in command:
+            outputPath = getTempFile(rootDir=tempDir)
+            tempPaths.append(outputPath)
+            command = command.replace("OUTPUT", outputPath)
+        process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE)
+        # Same as process.communicate(), except that we reap the
+        # process ourselves to get its resource usage.
+        def writeInput():
+            try:
+                if inputString is not None:
+                    process.stdin.write(inputString)
+                process.stdin.close()
+            except IOError as e:
+                # The command doesn't have to read all its input.
+                if e.errno != errno.EPIPE:
+                    raise
+        writer = threading.Thread(target=writeInput)
+        writer.start()
+        output = process.stdout.read()
+        process.stdout.close()
+        writer.join()
+        usage = waitForProcess(process)
+        if usages is not None:
+            usages.append(usage)
+        if process.returncode != 0:
+            raise RuntimeError("Command: %s exited with non-zero status %i" % (command, process.returncode))
+        if outputPath is not None:
+            output = open(outputPath).read()
+        return output
+    finally:
+        for path in tempPaths:
+            if os.path.exists(path):
+                os.remove(path)
+
+# Coalescences are written by ScoreColumns as a flat binary array of
+# native unsigned 32-bit records, one per coalescence. Each record is
+# (genome1 id * numGenomes + genome2 id) * len(OUTCOMES) + outcome,
+# where genome ids index SpeciesTree.genomes and the outcome indexes
+# OUTCOMES. Mismatch records, which need the full trees, are written
+# as text to a separate file (see getMismatchPath).
+OUTCOMES = ['identical', 'early', 'late']
+RECORD_TYPECODE = 'I'
+assert array(RECORD_TYPECODE).itemsize == 4
+# Partially-merged outputs are written as count tables of native
+# unsigned longs.
+COUNT_TYPECODE = 'L'
+
+def encodeCoalescenceRecord(genomeId1, genomeId2, outcome, numGenomes):
+    return (genomeId1 * numGenomes + genomeId2) * len(OUTCOMES) + outcome
+
+def getMismatchPath(outputFile):
+    """Get the path of the mismatch records for a job's output file."""
+    return outputFile + ".mismatches"
+
+def readRecordChunks(path, chunkSize=1 << 16, numRecords=None):
+    """Generate arrays of up to chunkSize coalescence records from a
+    job's output file (or only its first numRecords records), so memory
+    use is independent of its size."""
+    recordFile = open(path, 'rb')
+    while True:
+        chunk = array(RECORD_TYPECODE)
+        if numRecords is not None:
+            if numRecords == 0:
+                break
+            chunkSize = min(chunkSize, numRecords)
+            numRecords -= chunkSize
+        try:
+            chunk.fromfile(recordFile, chunkSize)
+        except EOFError:
+            # The partial final chunk is still filled in.
+            if len(chunk) != 0:
+                yield chunk
+            break
+        yield chunk
+    recordFile.close()
+
+class CoalescenceCounts:
+    """Genome x genome x outcome table of coalescence counts, stored as
+    a flat list indexed by the coalescence record value."""
+    def __init__(self, genomes):
+        self.genomes = genomes
+        self.counts = [0] * (len(genomes) * len(genomes) * len(OUTCOMES))
+
+    def addRecords(self, path, numRecords=None):
+        """Add the coalescence records in a job's output file (all of
+        them, or only the first numRecords)."""
+        counts = self.counts
+        for chunk in readRecordChunks(path, numRecords=numRecords):
+            for record in chunk:
+                counts[record] += 1
+
+    def addIncrements(self, path, numRecords=None):
+        """Add the (record, count) pairs in an --allPairs job's pending
+        counts file (all of them, or only the first numRecords
+        values)."""
+        counts = self.counts
+        for chunk in readRecordChunks(path, numRecords=numRecords):
+            for record, count in zip(chunk[0::2], chunk[1::2]):
+                counts[record] += count
+
+    def getCount(self, genomeId1, genomeId2, outcome):
+        return self.counts[encodeCoalescenceRecord(genomeId1, genomeId2, outcome, len(self.genomes))]
+
+    def getPairResults(self, genomeId1, genomeId2):
+        """Get the CoalescenceResults for coalescences between two
+        genomes, in either order. Pairs within the same genome are
+        counted twice, once for each order."""
+        results = [self.getCount(genomeId1, genomeId2, outcome) + self.getCount(genomeId2, genomeId1, outcome)
+                   for outcome in xrange(len(OUTCOMES))]
+        return CoalescenceResults(*results)
+
+    def getGenomeResults(self, genomeId, countSameGenomeOnce=False):
+        """Get the CoalescenceResults for all coalescences involving a
+        genome. Pairs within the genome are counted twice (as in the
+        XML output), unless countSameGenomeOnce is set."""
+        results = CoalescenceResults()
+        for otherId in xrange(len(self.genomes)):
+            if otherId == genomeId and countSameGenomeOnce:
+                results.add(CoalescenceResults(*[self.getCount(genomeId, genomeId, outcome)
+                                                 for outcome in xrange(len(OUTCOMES))]))
+            else:
+                results.add(self.getPairResults(genomeId, otherId))
+        return results
+
+    def getAggregateResults(self):
+        results = [sum(self.counts[outcome::len(OUTCOMES)]) for outcome in xrange(len(OUTCOMES))]
+        return CoalescenceResults(*results)
+
+    def addCounts(self, path):
+        """Add a partial count table written by writeCounts."""
+        partial = array(COUNT_TYPECODE)
+        partial.fromfile(open(path, 'rb'), len(self.counts))
+        for i, count in enumerate(partial):
+            self.counts[i] += count
+
+    def writeCounts(self, path):
+        countFile = open(path, 'wb')
+        array(COUNT_TYPECODE, self.counts).tofile(countFile)
+        countFile.close()
+
+def getCostsPath(outputFile):
+    """Get the path of the per-column cost report for a job's output
+    file."""
+    return outputFile + ".costs"
+
+def getStatsPath(outputFile):
+    """Get the path of the per-column statistics for a job's output
+    file."""
+    return outputFile + ".stats"
+
+def getCommitLogPath(outputFile):
+    """Get the path of the commit log (see ColumnCommitLog) for a job's
+    output file."""
+    return outputFile + ".commits"
+
+def getPendingCountsPath(outputFile):
+    """Get the path of the per-column count increments that an
+    --allPairs job writes as it goes, since its count table is only
+    written once it finishes."""
+    return outputFile + ".pending"
+
+# The stages of scoring a column, in order. Only the stages that run a
+# separate process (all but "score", and "reconcile" if
+# --reconcileInProcess is used) have a CPU time and peak RSS.
+STAGES = ['extract', 'align', 'estimate', 'reconcile', 'score']
+# Why a column may not be scored.
+SKIP_REASONS = ['duplicatePosition', 'tooFewSequences', 'notDuplicated']
+
+class ColumnStats:
+    """The outcome (either "scored" or one of SKIP_REASONS), size, and
+    per-stage wall time, child-process CPU time and peak RSS of a
+    single column. Stages that weren't run (or measured) are left
+    out of the dicts."""
+    def __init__(self, position, cached=False):
+        self.position = position
+        self.cached = cached
+        self.status = "scored"
+        self.numSequences = None
+        self.alignmentLength = None
+        self.wallTimes = {}
+        self.cpuTimes = {}
+        self.maxRSS = {}
+
+    def addUsage(self, stage, usages):
+        """Add the ProcessUsages of the processes run for a stage."""
+        for usage in usages:
+            self.cpuTimes[stage] = self.cpuTimes.get(stage, 0.0) + usage.cpuTime
+            self.maxRSS[stage] = max(self.maxRSS.get(stage, 0), usage.maxRSS)
+
+    def getPeakRSS(self):
+        """Get the largest peak RSS of any stage, or None."""
+        return max(self.maxRSS.values()) if len(self.maxRSS) != 0 else None
+
+    def toLine(self):
+        def formatValue(value, format):
+            return "NA" if value is None else format % value
+        fields = [self.position[0], str(self.position[1]), self.status,
+                  str(int(self.cached)), formatValue(self.numSequences, "%d"),
+                  formatValue(self.alignmentLength, "%d")]
+        for stage in STAGES:
+            fields.extend([formatValue(self.wallTimes.get(stage), "%f"),
+                           formatValue(self.cpuTimes.get(stage), "%f"),
+                           formatValue(self.maxRSS.get(stage), "%d")])
+        return "\t".join(fields) + "\n"
+
+COLUMN_STATS_HEADER = "\t".join(["#sequence", "position", "status", "cached",
+                                 "numSequences", "alignmentLength"] +
+                                ["%s%s" % (stage, field) for stage in STAGES
+                                 for field in ["WallTime", "CpuTime", "MaxRSS"]]) + "\n"
+
+def parseColumnStats(line):
+    """Parse a ColumnStats from a line written by ColumnStats.toLine."""
+    def parseValue(value, type):
+        return None if value == "NA" else type(value)
+    fields = line.rstrip("\n").split("\t")
+    stats = ColumnStats((fields[0], int(fields[1])), fields[3] == "1")
+    stats.status = fields[2]
+    stats.numSequences = parseValue(fields[4], int)
+    stats.alignmentLength = parseValue(fields[5], int)
+    for i, stage in enumerate(STAGES):
+        for valueDict, value, type in zip([stats.wallTimes, stats.cpuTimes, stats.maxRSS],
+                                          fields[6 + 3 * i:9 + 3 * i], [float, float, int]):
+            if value != "NA":
+                valueDict[stage] = type(value)
+    return stats
+
+def getAlignmentLength(alignment):
+    """Get the length of the first sequence in a fasta alignment."""
+    length = 0
+    seenHeader = False
+    for line in alignment.split("\n"):
+        if len(line) > 0 and line[0] == '>':
+            if seenHeader:
+                break
+            seenHeader = True
+        elif seenHeader:
+            length += len(line.strip())
+    return length
+
+def getLog2Histogram(values):
+    """Bin non-negative values into bins of [2^k, 2^(k+1)), returning a
+    sorted list of (min, max, count). Zeros get their own (0, 0) bin."""
+    binCounts = Counter()
+    for value in values:
+        if value <= 0:
+            binCounts[None] += 1
+        else:
+            binCounts[int(math.floor(math.log(value, 2)))] += 1
+    bins = []
+    if None in binCounts:
+        bins.append((0, 0, binCounts.pop(None)))
+    for k in sorted(binCounts):
+        bins.append((2.0 ** k, 2.0 ** (k + 1), binCounts[k]))
+    return bins
+
+def syncFile(path):
+    """Make sure everything written to a file is on disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def truncateFile(path, length):
+    fileHandle = open(path, 'r+b')
+    fileHandle.truncate(length)
+    fileHandle.close()
+
+def readCommitLog(path):
+    """Read a commit log written by ColumnCommitLog, returning the
+    committed ((records length, mismatches length), cost, ColumnStats)
+    entries and the length of the log's complete lines, or None if
+    there is no log. An incomplete last line (from a job killed while
+    committing) is ignored."""
+    try:
+        data = open(path, 'rb').read()
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    validLength = data.rfind("\n") + 1
+    entries = []
+    for line in data[:validLength].splitlines(True):
+        fields = line.split("\t", 3)
+        entries.append(((int(fields[0]), int(fields[1])), float(fields[2]),
+                        parseColumnStats(fields[3])))
+    return entries, validLength
+
+def getCommittedLengths(outputFile):
+    """Get the committed (records length, mismatches length) of a job's
+    output, or None if it has no commit log (as for partially-merged
+    outputs, which are only ever written whole)."""
+    log = readCommitLog(getCommitLogPath(outputFile))
+    if log is None:
+        return None
+    entries, _ = log
+    return entries[-1][0] if len(entries) != 0 else (0, 0)
+
+# How many columns, or seconds' worth of columns, to commit at once.
+# Syncing the output files for every column is slow on shared
+# filesystems, and only a batch is lost if a job is killed.
+COMMIT_BATCH_COLUMNS = 100
+COMMIT_BATCH_SECONDS = 10
+
+class ColumnCommitLog:
+    """Write-ahead log of the columns a ScoreColumns job has finished,
+    so that a retried job only redoes the unfinished ones.
+
+    Each column's results are appended to the job's records (or count
+    increments, with --allPairs) and mismatches before a line with the
+    new lengths of those files, the column's cost and its ColumnStats
+    is queued for the log. The lines are appended to the log in
+    batches, once the data files have been synced. Anything past the
+    last committed lengths is from a column that never committed."""
+    def __init__(self, outputFile, recordsPath):
+        self.path = getCommitLogPath(outputFile)
+        self.dataPaths = [recordsPath, getMismatchPath(outputFile)]
+        self.pendingLines = []
+        self.lastFlushTime = time.time()
+
+    def recover(self):
+        """Roll the log and data files back to the last commit (or to
+        nothing, on the first attempt), returning the committed
+        columns' (cost, ColumnStats)."""
+        log = readCommitLog(self.path)
+        entries, validLength = log if log is not None else ([], 0)
+        lengths = entries[-1][0] if len(entries) != 0 else (0, 0)
+        for path, length in zip(self.dataPaths + [self.path], list(lengths) + [validLength]):
+            if os.path.exists(path):
+                truncateFile(path, length)
+            elif length != 0:
+                raise RuntimeError("Committed file %s is missing" % path)
+        return [(cost, stats) for _, cost, stats in entries]
+
+    def commit(self, cost, stats):
+        """Commit a column whose results have all been written (and
+        their files closed). The commit only lasts once it's flushed,
+        which happens for every batch of columns."""
+        lengths = [os.path.getsize(path) if os.path.exists(path) else 0 for path in self.dataPaths]
+        self.pendingLines.append("%d\t%d\t%f\t%s" % (lengths[0], lengths[1], cost, stats.toLine()))
+        if len(self.pendingLines) >= COMMIT_BATCH_COLUMNS or \
+                time.time() - self.lastFlushTime >= COMMIT_BATCH_SECONDS:
+            self.flush()
+
+    def flush(self):
+        """Sync the data files, then append the pending commits to the
+        log."""
+        if len(self.pendingLines) != 0:
+            for path in self.dataPaths:
+                if os.path.exists(path):
+                    syncFile(path)
+            logFile = open(self.path, 'ab')
+            logFile.write("".join(self.pendingLines))
+            logFile.flush()
+            os.fsync(logFile.fileno())
+            logFile.close()
+            self.pendingLines = []
+        self.lastFlushTime = time.time()
+
+def concatenateSideFiles(outputs, getSidePath, destPath, lengths=None):
+    """Concatenate the side files (e.g. mismatches) of several outputs
+    into destPath. If given, lengths holds the number of bytes to take
+    from each side file (None for all of it)."""
+    destFile = open(destPath, 'w')
+    for i, output in enumerate(outputs):
+        if not os.path.exists(getSidePath(output)):
+            continue
+        length = lengths[i] if lengths is not None else None
+        if length is None:
+            for line in open(getSidePath(output)):
+                destFile.write(line)
+        else:
+            sideFile = open(getSidePath(output))
+            while length > 0:
+                data = sideFile.read(min(length, 1 << 20))
+                if len(data) == 0:
+                    break
+                destFile.write(data)
+                length -= len(data)
+            sideFile.close()
+    destFile.close()
+
+def mergeOutputs(counts, recordFiles, countFiles, mismatchPath, costsPath=None, statsPath=None):
+    """Add the coalescence records and partial count tables to counts,
+    and concatenate their mismatch records into mismatchPath, their
+    cost reports into costsPath and their column statistics into
+    statsPath (if not None). Only the committed part of each job's
+    records and mismatches is used."""
+    committedLengths = [getCommittedLengths(output) for output in recordFiles + countFiles]
+    recordSize = array(RECORD_TYPECODE).itemsize
+    for recordFile, lengths in zip(recordFiles, committedLengths):
+        numRecords = lengths[0] / recordSize if lengths is not None else None
+        # A job that had no columns to score writes nothing.
+        if os.path.exists(recordFile) and numRecords != 0:
+            counts.addRecords(recordFile, numRecords)
+    for countFile in countFiles:
+        counts.addCounts(countFile)
+    if mismatchPath is not None:
+        concatenateSideFiles(recordFiles + countFiles, getMismatchPath, mismatchPath,
+                             [lengths[1] if lengths is not None else None for lengths in committedLengths])
+    if costsPath is not None:
+        concatenateSideFiles(recordFiles + countFiles, getCostsPath, costsPath)
+    if statsPath is not None:
+        concatenateSideFiles(recordFiles + countFiles, getStatsPath, statsPath)
+
+def getColumnCache(opts):
+    """Get the ColumnCache for this run, or None if not caching."""
+    if opts.cacheDir is None:
+        return None
+    keyParams = [opts.halDigest, opts.refGenome, str(opts.width),
+                 opts.alignerCommand, opts.estimatorCommand,
+                 "reconcileInProcess" if opts.reconcileInProcess else "reconcileBinary"]
+    return ColumnCache(opts.cacheDir, int(opts.cacheMaxSize * 1024 ** 3), keyParams)
+
+def pipelineMap(function, inputs, numWorkers, maxPending):
+    """Generate function(item) for each item of the iterable inputs, in
+    order. The inputs are consumed in a separate thread, and function
+    is run by numWorkers threads, with at most maxPending items between
+    being read and their result being consumed. Exceptions (in inputs
+    or function) are re-raised when their item's result is reached."""
+    inputQueue = Queue.Queue()
+    outputQueue = Queue.Queue()
+    pendingSlots = threading.Semaphore(maxPending)
+    finished = threading.Event()
+
+    def feed():
+        i = 0
+        try:
+            for item in inputs:
+                pendingSlots.acquire()
+                if finished.is_set():
+                    return
+                inputQueue.put((i, item))
+                i += 1
+        except:
+            outputQueue.put((i, None, sys.exc_info()))
+        finally:
+            for _ in xrange(numWorkers):
+                inputQueue.put(None)
+
+    def work():
+        while True:
+            task = inputQueue.get()
+            if task is None:
+                return
+            i, item = task
+            try:
+                outputQueue.put((i, function(item), None))
+            except:
+                outputQueue.put((i, None, sys.exc_info()))
+
+    threads = [threading.Thread(target=feed)] + [threading.Thread(target=work) for _ in xrange(numWorkers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        results = {}
+        nextIndex = 0
+        while True:
+            if all(not thread.is_alive() for thread in threads) and outputQueue.empty() \
+                    and nextIndex not in results:
+                return
+            try:
+                i, result, exception = outputQueue.get(timeout=1)
+            except Queue.Empty:
+                continue
+            results[i] = (result, exception)
+            while nextIndex in results:
+                result, exception = results.pop(nextIndex)
+                if exception is not None:
+                    raise exception[0], exception[1], exception[2]
+                yield result
+                pendingSlots.release()
+                nextIndex += 1
+    finally:
+        # Stop the feeder if we're exiting early.
+        finished.set()
+        pendingSlots.release()
+
+# Options naming a file for a single hal file, which take a
+# comma-separated list (one per hal file) when scoring several at once.
+PER_HAL_OPTIONS = ['halFile', 'outputFile', 'costReport', 'columnStats', 'writeMismatchesToFile']
+
+def splitHalOpts(opts):
+    """Get a copy of the options for each of the (comma-separated) hal
+    files, with the per-hal options set to that hal file's entry."""
+    halFiles = opts.halFile.split(",")
+    halOpts = [copy.copy(opts) for _ in halFiles]
+    for option in PER_HAL_OPTIONS:
+        value = getattr(opts, option)
+        if value is None:
+            continue
+        values = value.split(",")
+        if len(values) != len(halFiles):
+            raise ValueError("%s has %d entries, but there are %d hal files" % (option, len(values), len(halFiles)))
+        for halOpt, value in zip(halOpts, values):
+            setattr(halOpt, option, value)
+    return halOpts
 
 class Setup(Target):
-    """Launch the sampling jobs and send the scores to the output
-    phase."""
+    """Sample the reference positions, and score them in each hal
+    file."""
     def __init__(self, opts):
         Target.__init__(self)
         self.opts = opts
 
     def run(self):
-        speciesTree = popenCatch("halStats --tree %s" % (self.opts.halFile)).strip()
-        chromSizes = getChromSizes(self.opts.halFile, self.opts.refGenome)
+        if self.opts.seed is not None:
+            random.seed(self.opts.seed)
+        halOpts = splitHalOpts(self.opts)
+        # Every hal file is scored on the same positions, so their
+        # results are directly comparable.
+        chromSizes = getChromSizes(halOpts[0].halFile, self.opts.refGenome)
+        for opts in halOpts[1:]:
+            if getChromSizes(opts.halFile, opts.refGenome) != chromSizes:
+                raise RuntimeError("The sequences of %s differ between %s and %s" % (self.opts.refGenome, halOpts[0].halFile, opts.halFile))
+        if self.opts.sampleBed is not None:
+            regions = getRegionsFromBed(self.opts.sampleBed, chromSizes)
+        else:
+            regions = getRegionsFromChromSizes(chromSizes)
 
-        positions = []
+        # Have to sample the columns here since otherwise it can
+        # be difficult to independently seed several RNGs
+        positions = PositionSampler(regions).sampleUniquePositions(self.opts.numSamples)
         # For ensuring that a column isn't counted multiple times from
         # different reference positions.
-        positionSet = set(positions)
-        for i in xrange(self.opts.numSamples):
-            # Have to sample the columns here since otherwise it can
-            # be difficult to independently seed several RNGs
-            pos = samplePosition(chromSizes)
-            if pos not in positionSet:
-                positions.append(pos)
-                positionSet.add(pos)
+        positionSet = PositionIndex.write(positions, getTempFile(rootDir=self.getGlobalTempDir()))
+        # All the hal files' jobs are scheduled together, rather than
+        # one hal file after another.
+        for opts in halOpts:
+            self.addChildTarget(ScoreHal(opts, positions, positionSet))
+
+class ScoreHal(Target):
+    """Launch the sampling jobs for a single hal file and send the
+    scores to the output phase."""
+    def __init__(self, opts, positions, positionSet):
+        Target.__init__(self)
+        self.opts = opts
+        self.positions = positions
+        self.positionSet = positionSet
+
+    def run(self):
+        if self.opts.cacheDir is not None:
+            # Identifies the hal file in the column cache keys. The
+            # options are pickled into every child, so they all see it.
+            self.opts.halDigest = getFileDigest(self.opts.halFile)
+        speciesTree = SpeciesTree(popenCatch("halStats --tree %s" % (self.opts.halFile)).strip())
+        # Skip the columns that wouldn't be scored up front, rather than
+        # after extracting them. The index still has every sampled
+        # position, since it decides which position a column is scored
+        # from.
+        self.opts.prefilterStats = getTempFile(rootDir=self.getGlobalTempDir())
+        positions, costs = prefilterPositions(self.opts, self.positions, self.positionSet,
+                                              getTempFile(rootDir=self.getLocalTempDir()),
+                                              self.opts.prefilterStats)
+
+        if self.opts.targetCI is not None:
+            # The positions were sampled in random order, so scoring
+            # them in waves scores a random subset of the columns.
+            self.setFollowOnTarget(SampleInWaves(self.opts, positions, costs, self.positionSet, speciesTree))
+            return
 
-        outputs = []
-        for sliceStart in xrange(0, self.opts.numSamples,
-                                 self.opts.samplesPerJob):
-            slice = positions[sliceStart:sliceStart + self.opts.samplesPerJob]
-            outputFile = getTempFile(rootDir=self.getGlobalTempDir())
-            outputs.append(outputFile)
-            self.addChildTarget(ScoreColumns(self.opts, slice,
-                                             outputFile, speciesTree, positionSet))
-        self.setFollowOnTarget(Summarize(self.opts, outputs, self.opts.outputFile, self.opts.writeMismatchesToFile))
+        outputs = addScoringTargets(self, self.opts, positions, costs, self.positionSet, speciesTree)
+        recordFiles, countFiles = splitJobOutputs(self.opts, outputs)
+        self.setFollowOnTarget(ReduceOutputs(self.opts, recordFiles, countFiles, speciesTree))
+
+def getColumnSkipReason(opts, position, refGenomePoss, genomeCounts, positionSet):
+    """Get the reason (one of SKIP_REASONS) that a column shouldn't be
+    scored from this position, or None if it should be scored, given
+    the ref genome's (sequence, position)s in the column and the number
+    of sequences from each genome."""
+    # Ensure that we only do each column once, by looking at the ref
+    # genome's positions in the column. If this is not the lowest
+    # position that was sampled, then we should stop to avoid
+    # double-counting a column.
+    if min((p for p in refGenomePoss if p in positionSet), key=lambda x: x[1]) != position:
+        return 'duplicatePosition'
+
+    # Check that the column actually has enough sequences to bother
+    # with tree-building, and make sure it's duplicated if we want only
+    # duplicated columns.
+    if sum(genomeCounts.values()) <= 3:
+        return 'tooFewSequences'
+    if not opts.nonDuplicated and all(count <= 1 for count in genomeCounts.values()):
+        return 'notDuplicated'
+    return None
+
+def getColumnMembers(halFile, refGenome, positions, positionsPath):
+    """Get the (ref genome (sequence, position)s, Counter of sequences
+    per genome) in the column at each position, without extracting the
+    columns."""
+    writePositionsFile(positions, positionsPath)
+    output = popenCatch("getRegionAroundSampledColumn %s %s --positionsFile %s --membersOnly" % (halFile, refGenome, positionsPath))
+    members = {}
+    for line in output.split("\n"):
+        fields = line.split("\t")
+        if len(fields) != 4:
+            continue
+        genomeCounts = Counter()
+        for genomeCount in fields[2].split(","):
+            genome, count = genomeCount.rsplit("=", 1)
+            genomeCounts[genome] = int(count)
+        refGenomePoss = set((entry.split("|")[0], int(entry.split("|")[-1])) for entry in fields[3].split(",") if entry != "")
+        members[(fields[0], int(fields[1]))] = (refGenomePoss, genomeCounts)
+    return [members[position] for position in positions]
+
+def prefilterPositions(opts, positions, positionSet, positionsPath, statsPath):
+    """Drop the positions whose columns wouldn't be scored (because
+    they were already sampled from another position, or are too small
+    or not duplicated), so that no jobs are spent extracting them.
+    Their ColumnStats are written to statsPath. Returns the remaining
+    positions, in the same order, and their predicted costs (see
+    predictColumnCost)."""
+    keptPositions = []
+    costs = []
+    statsFile = open(statsPath, 'w')
+    members = getColumnMembers(opts.halFile, opts.refGenome, positions, positionsPath)
+    for position, (refGenomePoss, genomeCounts) in zip(positions, members):
+        skipReason = getColumnSkipReason(opts, position, refGenomePoss, genomeCounts, positionSet)
+        if skipReason is None:
+            keptPositions.append(position)
+            costs.append(predictColumnCost(sum(genomeCounts.values())))
+            continue
+        stats = ColumnStats(position)
+        stats.status = skipReason
+        stats.numSequences = sum(genomeCounts.values())
+        statsFile.write(stats.toLine())
+    statsFile.close()
+    return keptPositions, costs
+
+def writePositionsFile(positions, positionsPath):
+    """Write positions in the format taken by
+    getRegionAroundSampledColumn's --positionsFile."""
+    positionsHandle = open(positionsPath, 'w')
+    for seq, pos in positions:
+        positionsHandle.write("%s\t%d\n" % (seq, pos))
+    positionsHandle.close()
+
+def predictColumnCost(numSequences):
+    """Predict the relative cost of scoring a column. Columns with too
+    few sequences are skipped almost immediately; otherwise alignment
+    and tree estimation dominate, and grow roughly quadratically with
+    the number of sequences."""
+    if numSequences <= 3:
+        return 1
+    return 10 + numSequences ** 2
+
+def packByCost(positions, costs, numJobs):
+    """Split positions into numJobs jobs with roughly equal total cost,
+    by assigning the most expensive remaining position to the job with
+    the lowest total cost so far. Returns a list of (positions, costs)
+    for each job."""
+    jobs = [([], []) for _ in xrange(numJobs)]
+    heap = [(0, i) for i in xrange(numJobs)]
+    for cost, position in sorted(zip(costs, positions), reverse=True):
+        jobCost, i = heapq.heappop(heap)
+        jobs[i][0].append(position)
+        jobs[i][1].append(cost)
+        heapq.heappush(heap, (jobCost + cost, i))
+    return jobs
+
+def getJobSeed(opts, positions):
+    """Get the seed for the coalescence sampling of a job, derived from
+    --seed and the job's first position so that it doesn't depend on
+    the order in which jobs happen to run. None if --seed isn't set."""
+    if opts.seed is None:
+        return None
+    key = "%d\t%s\t%d" % (opts.seed, positions[0][0], positions[0][1])
+    return int(hashlib.md5(key).hexdigest(), 16)
+
+def getColumnSeed(jobSeed, position):
+    """Get the seed for sampling a column's coalescences, so that a
+    retried job that skips its committed columns samples the rest
+    exactly as the first attempt would have."""
+    key = "%d\t%s\t%d" % (jobSeed, position[0], position[1])
+    return int(hashlib.md5(key).hexdigest(), 16)
+
+def addScoringTargets(target, opts, positions, costs, positionSet, speciesTree):
+    """Add ScoreColumns children to target for the given positions (with
+    the given predicted costs), --samplesPerJob positions per job.
+    Returns the job output paths."""
+    numJobs = (len(positions) + opts.samplesPerJob - 1) / opts.samplesPerJob
+    if opts.packByCost:
+        jobs = packByCost(positions, costs, numJobs)
+    else:
+        jobs = []
+        for sliceStart in xrange(0, len(positions), opts.samplesPerJob):
+            jobs.append((positions[sliceStart:sliceStart + opts.samplesPerJob], None))
+    outputs = []
+    for jobPositions, predictedCosts in jobs:
+        outputFile = getTempFile(rootDir=target.getGlobalTempDir())
+        outputs.append(outputFile)
+        target.addChildTarget(ScoreColumns(opts, jobPositions,
+                                           outputFile, speciesTree, positionSet,
+                                           predictedCosts, getJobSeed(opts, jobPositions)))
+    return outputs
+
+def splitJobOutputs(opts, outputs):
+    """Split ScoreColumns outputs into (record files, count files): with
+    --allPairs, jobs write count tables instead of records."""
+    if opts.allPairs:
+        return [], list(outputs)
+    return list(outputs), []
+
+def getWilsonHalfWidth(successes, total, z=1.96):
+    """Get the half-width of the Wilson score interval (95% by default)
+    for a binomial proportion."""
+    if total == 0:
+        return float('inf')
+    p = float(successes) / total
+    denominator = 1 + z * z / total
+    return z * math.sqrt(p * (1 - p) / total + z * z / (4.0 * total * total)) / denominator
+
+def getAchievedCI(counts, perGenome):
+    """Get the widest confidence-interval half-width among the
+    identical/early/late fractions, over the aggregate results and,
+    optionally, each genome's results."""
+    resultsToCheck = [counts.getAggregateResults()]
+    if perGenome:
+        for genomeId in xrange(len(counts.genomes)):
+            results = counts.getGenomeResults(genomeId, countSameGenomeOnce=True)
+            if results.identical + results.early + results.late != 0:
+                resultsToCheck.append(results)
+    widest = 0.0
+    for results in resultsToCheck:
+        total = results.identical + results.early + results.late
+        for outcome in OUTCOMES:
+            widest = max(widest, getWilsonHalfWidth(getattr(results, outcome), total))
+    return widest
+
+class SampleInWaves(Target):
+    """Score the sampled positions in waves of --waveSize columns,
+    stopping once the confidence intervals on the coalescence
+    fractions are at most --targetCI wide (or the positions run out).
+    Each wave merges the previous wave's outputs into a running count
+    table."""
+    def __init__(self, opts, positions, costs, positionSet, speciesTree, waveStart=0,
+                 countFile=None, recordFiles=None, numWaves=0):
+        Target.__init__(self)
+        self.opts = opts
+        self.positions = positions
+        self.costs = costs
+        self.positionSet = positionSet
+        self.speciesTree = speciesTree
+        self.waveStart = waveStart
+        self.countFile = countFile
+        if recordFiles is None:
+            recordFiles = []
+        self.recordFiles = recordFiles
+        self.numWaves = numWaves
+
+    def run(self):
+        counts = CoalescenceCounts(self.speciesTree.genomes)
+        countFile = getTempFile(rootDir=self.getGlobalTempDir())
+        mismatchPath = None
+        if self.opts.writeMismatchesToFile is not None:
+            mismatchPath = getMismatchPath(countFile)
+        recordFiles, previousCountFiles = splitJobOutputs(self.opts, self.recordFiles)
+        if self.countFile is not None:
+            previousCountFiles.append(self.countFile)
+        costsPath = None
+        if self.opts.costReport is not None:
+            costsPath = getCostsPath(countFile)
+        mergeOutputs(counts, recordFiles, previousCountFiles, mismatchPath, costsPath,
+                     getStatsPath(countFile))
+        counts.writeCounts(countFile)
+
+        achievedCI = getAchievedCI(counts, self.opts.perGenomeCI)
+        if self.waveStart >= len(self.positions) or achievedCI <= self.opts.targetCI:
+            samplingPrecision = (self.opts.targetCI, achievedCI, self.waveStart, self.numWaves)
+            self.setFollowOnTarget(Summarize(self.opts, [], self.opts.outputFile,
+                                             self.opts.writeMismatchesToFile, self.speciesTree,
+                                             [countFile], samplingPrecision))
+            return
+
+        waveEnd = self.waveStart + self.opts.waveSize
+        wave = self.positions[self.waveStart:waveEnd]
+        outputs = addScoringTargets(self, self.opts, wave, self.costs[self.waveStart:waveEnd],
+                                    self.positionSet, self.speciesTree)
+        self.setFollowOnTarget(SampleInWaves(self.opts, self.positions, self.costs, self.positionSet,
+                                             self.speciesTree, self.waveStart + len(wave),
+                                             countFile, outputs, self.numWaves + 1))
 
 class ScoreColumns(Target):
     """Get a column from the hal, realign the region surrounding the
@@ -185,85 +1317,219 @@ class ScoreColumns(Target):
     independently estimated tree against the one in the hal
     graph.
     """
-    def __init__(self, opts, positions, outputFile, speciesTree, positionSet):
+    def __init__(self, opts, positions, outputFile, speciesTree, positionSet,
+                 predictedCosts=None, seed=None):
         Target.__init__(self)
         self.opts = opts
         self.positions = positions
         self.outputFile = outputFile
         self.speciesTree = speciesTree
         self.positionSet = positionSet
+        # Predicted relative cost of each position, if packed by cost.
+        self.predictedCosts = predictedCosts
+        self.seed = seed
 
     def run(self):
+        if self.opts.allPairs:
+            # Every pair is scored, so the job's output is a count table
+            # rather than one record per coalescence. Until the job
+            # finishes, each column's counts are kept as increments.
+            recordsPath = getPendingCountsPath(self.outputFile)
+        else:
+            recordsPath = self.outputFile
+        # If this is a retry, pick up where the last attempt left off.
+        commitLog = ColumnCommitLog(self.outputFile, recordsPath)
+        committed = dict((stats.position, (cost, stats)) for cost, stats in commitLog.recover())
+        if self.opts.allPairs:
+            self.allPairsCounts = CoalescenceCounts(self.speciesTree.genomes)
+            if os.path.exists(recordsPath):
+                self.allPairsCounts.addIncrements(recordsPath)
+        remainingPositions = [position for position in self.positions if position not in committed]
+
+        columnCache = getColumnCache(self.opts)
+        cachedColumns = {}
+        if columnCache is not None:
+            for position in remainingPositions:
+                entry = columnCache.get(position)
+                if entry is not None:
+                    cachedColumns[position] = entry
+        uncachedPositions = [position for position in remainingPositions if position not in cachedColumns]
+        positionsPath = getTempFile(rootDir=self.getLocalTempDir())
+        # Temporary files are only needed for tools that insist on
+        # paths, and are kept off the shared filesystem.
+        tempDir = self.opts.columnTempDir
+        if tempDir is None:
+            tempDir = self.getLocalTempDir()
+
+        extractionUsages = []
+
+        def getColumns():
+            # Yields each position's stats along with either its cache
+            # entry or its extracted fasta.
+            extractedColumns = extractColumns(self.opts.halFile, self.opts.refGenome,
+                                              uncachedPositions, self.opts.width,
+                                              positionsPath, extractionUsages)
+            for position in remainingPositions:
+                if position in cachedColumns:
+                    yield ColumnStats(position, cached=True), cachedColumns[position], None
+                else:
+                    stats = ColumnStats(position)
+                    startTime = time.time()
+                    extractedPosition, fasta = extractedColumns.next()
+                    stats.wallTimes['extract'] = time.time() - startTime
+                    if extractedPosition != position:
+                        raise RuntimeError("getRegionAroundSampledColumn output the column at %s:%d "
+                                           "where the column at %s:%d was expected" % (extractedPosition + position))
+                    yield stats, None, fasta
+            if len(uncachedPositions) != 0:
+                # Let the extraction process finish and check its status.
+                if next(extractedColumns, None) is not None:
+                    raise RuntimeError("getRegionAroundSampledColumn output more columns than "
+                                       "the %d it was given" % (len(uncachedPositions)))
+
+        def prepare(column):
+            stats, cacheEntry, fasta = column
+            startTime = time.time()
+            if cacheEntry is not None:
+                prepared = self.prepareCachedColumn(stats, *cacheEntry)
+            else:
+                prepared = self.prepareColumn(stats, fasta, tempDir, columnCache)
+            return prepared, stats, time.time() - startTime
+
+        # Extraction, alignment/estimation/reconciliation and scoring
+        # all run concurrently; the columns are scored in order, so the
+        # output doesn't depend on the number of workers. Each column's
+        # coalescences are sampled with its own seed, so they don't
+        # depend on how many columns a retry skipped either.
+        newStats = []
+        try:
+            for prepared, stats, seconds in pipelineMap(prepare, getColumns(),
+                                                        self.opts.workersPerJob,
+                                                        2 * self.opts.workersPerJob + 1):
+                startTime = time.time()
+                if prepared is not None:
+                    if self.seed is not None:
+                        random.seed(getColumnSeed(self.seed, stats.position))
+                    self.reportCorrectCoalescences(stats.position, *prepared)
+                    stats.wallTimes['score'] = time.time() - startTime
+                cost = seconds + time.time() - startTime
+                commitLog.commit(cost, stats)
+                committed[stats.position] = (cost, stats)
+                newStats.append(stats)
+        finally:
+            # Keep the finished columns even if a later one failed.
+            commitLog.flush()
+
+        # All the columns come from a single extraction process, so its
+        # CPU time is split evenly between them. (Columns committed by
+        # an earlier attempt don't get any.)
+        extractedStats = [stats for stats in newStats if not stats.cached]
+        for usage in extractionUsages:
+            for stats in extractedStats:
+                stats.addUsage('extract', [ProcessUsage(usage.cpuTime / len(extractedStats), usage.maxRSS)])
+        statsFile = open(getStatsPath(self.outputFile), 'w')
         for position in self.positions:
-            self.handleColumn(position)
+            statsFile.write(committed[position][1].toLine())
+        statsFile.close()
+        if self.opts.allPairs:
+            self.allPairsCounts.writeCounts(self.outputFile)
+
+        if self.opts.costReport is not None:
+            # Report the predicted vs. actual cost of each column.
+            costsFile = open(getCostsPath(self.outputFile), 'w')
+            for i, position in enumerate(self.positions):
+                predictedCost = "NA" if self.predictedCosts is None else str(self.predictedCosts[i])
+                costsFile.write("%s\t%d\t%s\t%s\t%f\n" % (position[0], position[1], self.outputFile,
+                                                             predictedCost, committed[position][0]))
+            costsFile.close()
+        if columnCache is not None:
+            columnCache.evict()
+
+    def getSkipReason(self, position, headers):
+        """Get the reason (one of SKIP_REASONS) that a column (given its
+        sequence names) shouldn't be scored from this position, or None
+        if it should be scored."""
+        refGenomePoss = set((".".join(h.split("|")[0].split(".")[1:]), int(h.split("|")[-1])) for h in headers if h.split(".")[0] == self.opts.refGenome)
+        genomeCounts = Counter(parseColumnEntryFromString(i).genome for i in headers)
+        return getColumnSkipReason(self.opts, position, refGenomePoss, genomeCounts, self.positionSet)
+
+    def prepareCachedColumn(self, stats, halTree, alignment, reconciledNewick):
+        """Get the (hal tree newick, reconciled tree) to score for a
+        cached column, or None if it shouldn't be scored."""
+        headers = [l[1:].strip() for l in alignment.split("\n") if len(l) > 0 and l[0] == '>']
+        stats.numSequences = len(headers)
+        stats.alignmentLength = getAlignmentLength(alignment)
+        skipReason = self.getSkipReason(stats.position, headers)
+        if skipReason is not None:
+            stats.status = skipReason
+            return None
+        return halTree, NodeTree(parseNewick(reconciledNewick))
 
-    def handleColumn(self, position):
-        # Get the column.
-        fasta = popenCatch("getRegionAroundSampledColumn %s %s --refSequence %s --refPos %d" % (self.opts.halFile, self.opts.refGenome, position[0], position[1]))
+    def prepareColumn(self, stats, fasta, tempDir, columnCache=None):
+        """Realign an extracted column, estimate its tree, and reconcile
+        it, recording the time and resources taken in stats. Returns the
+        (hal tree newick, reconciled tree) to score, or None if the
+        column shouldn't be scored."""
+        position = stats.position
         # Take out the tree (on the first line) in case the aligner is
         # picky (read: correct) about fasta parsing.
         fastaLines = fasta.split("\n")
         halTree = fastaLines[0][1:] # Skip '#' character.
 
-        # Ensure that we only do each column once, by looking at the
-        # ref genome's positions in the column. If this is not the
-        # lowest position that was sampled, then we should stop to
-        # avoid double-counting a column.
-        headers = [l[1:] for l in fastaLines if len(l) > 0 and l[0] == '>']
-        refGenomePoss = set((".".join(h.split("|")[0].split(".")[1:]), int(h.split("|")[-1])) for h in headers if h.split(".")[0] == self.opts.refGenome)
-        if min(refGenomePoss.intersection(self.positionSet), key=lambda x: x[1]) != position:
-            return
-
-        # Check that the fasta actually has enough sequences to bother
-        # with tree-building, and make sure it's duplicated if we want
-        # only duplicated columns.
-        seqNames = []
-        for line in fastaLines:
-            if len(line) != 0 and line[0] == '>':
-                seqNames.append(line[1:])
-        numGenomeAppearances = Counter(parseColumnEntryFromString(i).genome for i in seqNames)
-        duplicatedGenomes = set(k for k, v in numGenomeAppearances.items() if v > 1)
-        if len(seqNames) <= 3 or (not self.opts.nonDuplicated and len(duplicatedGenomes) == 0):
-            return
+        seqNames = [l[1:] for l in fastaLines if len(l) > 0 and l[0] == '>']
+        stats.numSequences = len(seqNames)
+        skipReason = self.getSkipReason(position, seqNames)
+        if skipReason is not None:
+            stats.status = skipReason
+            return None
 
         # Get rid of the initial comment line containing the newick tree.
         fasta = "\n".join(fastaLines[1:])
 
         # Align the region surrounding the column.
-        alignInputPath = getTempFile(rootDir=self.getGlobalTempDir())
-        open(alignInputPath, 'w').write(fasta)
-        alignOutputPath = getTempFile(rootDir=self.getGlobalTempDir())
-        alignCommand = self.opts.alignerCommand.replace("INPUT", alignInputPath).replace("OUTPUT", alignOutputPath)
-        system(alignCommand)
+        startTime = time.time()
+        usages = []
+        alignment = runPipedCommand(self.opts.alignerCommand, fasta, tempDir, usages)
+        stats.wallTimes['align'] = time.time() - startTime
+        stats.addUsage('align', usages)
+        stats.alignmentLength = getAlignmentLength(alignment)
 
         # Estimate a tree on the new alignment.
-        treeOutputPath = getTempFile(rootDir=self.getGlobalTempDir())
-        estimateCommand = self.opts.estimatorCommand.replace("INPUT", alignOutputPath).replace("OUTPUT", treeOutputPath)
-        system(estimateCommand)
-        estimatedTree = open(treeOutputPath).read().strip()
-
-        # Reconcile against the species tree.
+        startTime = time.time()
+        usages = []
+        estimatedTree = runPipedCommand(self.opts.estimatorCommand, alignment, tempDir, usages).strip()
+        stats.wallTimes['estimate'] = time.time() - startTime
+        stats.addUsage('estimate', usages)
 
-        # Make a spimap-esque "gene2species" file from the fact that
+        # Reconcile against the species tree, using the fact that
         # our sequences are labeled as genome.species|centerPos.
-        gene2speciesPath = getTempFile(rootDir=self.getGlobalTempDir())
-        gene2speciesHandle = open(gene2speciesPath, 'w')
-        for line in fastaLines:
-            if len(line) != 0 and line[0] == '>':
-                header = line[1:]
-                species = header.split(".")[0]
-                gene2speciesHandle.write("%s\t%s\n" % (header, species))
-        gene2speciesHandle.close()
-
-        reconciled = popenCatch("reconcile '%s' '%s' '%s' 0 1" % (gene2speciesPath, estimatedTree, self.speciesTree))
-
-        # Score the two trees
-        self.reportCorrectCoalescences(position, halTree, reconciled)
-
-    def reportCorrectCoalescences(self, position, halNewick, reconciledNewick):
-        output = open(self.outputFile, 'a')
-        hal = NXNewick().parseString(halNewick)
-        reconciled = NXNewick().parseString(reconciledNewick)
+        startTime = time.time()
+        if not self.opts.reconcileInProcess:
+            # Make a spimap-esque "gene2species" file.
+            gene2species = "".join("%s\t%s\n" % (name, name.split(".")[0]) for name in seqNames)
+            usages = []
+            reconciledNewick = runPipedCommand("reconcile /dev/stdin '%s' '%s' 0 1" % (estimatedTree, self.speciesTree.newick), gene2species, tempDir, usages)
+            stats.addUsage('reconcile', usages)
+            reconciled = parseNewick(reconciledNewick)
+        else:
+            leafToSpecies = dict((name, name.split(".")[0]) for name in seqNames)
+            reconciled = reconcileGeneTree(parseNewick(estimatedTree),
+                                           self.speciesTree.reconciliationIndex,
+                                           leafToSpecies, reRoot=True)
+        stats.wallTimes['reconcile'] = time.time() - startTime
+
+        if columnCache is not None:
+            columnCache.put(position, halTree, alignment, writeNewick(reconciled))
+
+        return halTree, NodeTree(reconciled)
+
+    def reportCorrectCoalescences(self, position, halNewick, reconciled):
+        if self.opts.allPairs:
+            self.reportAllCoalescences(position, halNewick, reconciled)
+            return
+        records = array(RECORD_TYPECODE)
+        numGenomes = len(self.speciesTree.genomes)
+        hal = parseCompactNewick(halNewick)
         if self.opts.onlySelf:
             requiredPosition = ColumnEntry(self.opts.refGenome, position[0], position[1])
         else:
@@ -271,6 +1537,7 @@ class ScoreColumns(Target):
         halCoalescences = sampleCoalescences(hal, self.opts.coalescencesPerSample, self.opts.nonDuplicated, requiredPosition)
         reconciledCoalescences = matchCoalescences(reconciled, halCoalescences)
         assert(len(halCoalescences) == len(reconciledCoalescences))
+        mismatches = []
         for halCoalescence, reconciledCoalescence in zip(halCoalescences, reconciledCoalescences):
             assert(halCoalescence.genome1 == reconciledCoalescence.genome1)
             assert(halCoalescence.seq1 == reconciledCoalescence.seq1)
@@ -278,109 +1545,243 @@ class ScoreColumns(Target):
             assert(halCoalescence.genome2 == reconciledCoalescence.genome2)
             assert(halCoalescence.seq2 == reconciledCoalescence.seq2)
             assert(halCoalescence.pos2 == reconciledCoalescence.pos2)
-            result = None
-            speciesTree = NXNewick().parseString(self.speciesTree)
-            nameToId = getNameToIdDict(speciesTree)
             # Have to get rid of the sequence/position information
             # in the hal MRCA
             halMrca = halCoalescence.mrca.split(".")[0]
-            assert halMrca in nameToId
-            reconciledId = nameToId[reconciledCoalescence.mrca]
-            halId = nameToId[halMrca]
-            id = getMRCA(speciesTree, halId, reconciledId)
-            assert id == halId or id == reconciledId
-            if reconciledId == halId:
-                result = "identical"
-            elif id == halId:
-                # Late in hal relative to independent estimate
-                result = "late"
-            else:
-                # Early in hal relative to independent estimate
-                result = "early"
+            result = self.speciesTree.compareMRCAs(halMrca, reconciledCoalescence.mrca)
             if result != "identical" and self.opts.writeMismatchesToFile:
-                output.write("mismatch\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n" % (halCoalescence.genome1, halCoalescence.seq1, halCoalescence.pos1, halCoalescence.genome2, halCoalescence.seq2, halCoalescence.pos2, halMrca, reconciledCoalescence.mrca, result, halNewick, reconciledNewick))
-            output.write("coalescence\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n" % (halCoalescence.genome1, halCoalescence.seq1, halCoalescence.pos1, halCoalescence.genome2, halCoalescence.seq2, halCoalescence.pos2, result))
+                mismatches.append((halCoalescence, halMrca, reconciledCoalescence.mrca, result))
+            records.append(encodeCoalescenceRecord(self.speciesTree.genomeIds[halCoalescence.genome1],
+                                                   self.speciesTree.genomeIds[halCoalescence.genome2],
+                                                   OUTCOMES.index(result), numGenomes))
+        if len(mismatches) != 0:
+            reconciledNewick = writeNewick(reconciled.getRootId())
+            mismatchOutput = open(getMismatchPath(self.outputFile), 'a')
+            for halCoalescence, halMrca, reconciledMrca, result in mismatches:
+                mismatchOutput.write("mismatch\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n" % (halCoalescence.genome1, halCoalescence.seq1, halCoalescence.pos1, halCoalescence.genome2, halCoalescence.seq2, halCoalescence.pos2, halMrca, reconciledMrca, result, halNewick, reconciledNewick))
+            mismatchOutput.close()
+        output = open(self.outputFile, 'ab')
+        records.tofile(output)
+        output.close()
+
+    def reportAllCoalescences(self, position, halNewick, reconciled):
+        """Score every eligible pair of leaves in a column (or, with
+        --onlySelf, every pair including the sampled position), adding
+        them to self.allPairsCounts."""
+        hal = parseCompactNewick(halNewick)
+        leaves = sorted(getColumnLeaves(hal))
+        eligibleLeaves = getEligibleLeaves(leaves, self.opts.nonDuplicated)
+        numLeaves = len(eligibleLeaves)
+        leafIndices = dict((name, i) for i, (name, _) in enumerate(eligibleLeaves))
+        speciesIds = self.speciesTree.genomeIds
+        halMrcas = getPairMrcaSpecies(hal, leafIndices, speciesIds, lambda name: name.split(".")[0])
+        reconciledMrcas = getPairMrcaSpecies(reconciled, leafIndices, speciesIds, lambda name: name)
+
+        if self.opts.onlySelf:
+            requiredName = "%s.%s|%s" % (self.opts.refGenome, position[0], position[1])
+            if requiredName not in leafIndices:
+                return
+            required = leafIndices[requiredName]
+            pairs = [(min(i, required), max(i, required)) for i in xrange(numLeaves) if i != required]
+        else:
+            pairs = ((i, j) for i in xrange(numLeaves) for j in xrange(i + 1, numLeaves))
+
+        numSpecies = len(self.speciesTree.genomes)
+        outcomeTable = self.speciesTree.getOutcomeTable()
+        leafGenomeIds = [speciesIds[entry.genome] for _, entry in eligibleLeaves]
+        counts = [0] * len(self.allPairsCounts.counts)
+        mismatches = []
+        for i, j in pairs:
+            halMrca = halMrcas[i * numLeaves + j]
+            reconciledMrca = reconciledMrcas[i * numLeaves + j]
+            outcome = outcomeTable[halMrca * numSpecies + reconciledMrca]
+            counts[encodeCoalescenceRecord(leafGenomeIds[i], leafGenomeIds[j], outcome, numSpecies)] += 1
+            if outcome != 0 and self.opts.writeMismatchesToFile:
+                mismatches.append((i, j, halMrca, reconciledMrca, outcome))
+        if len(mismatches) != 0:
+            reconciledNewick = writeNewick(reconciled.getRootId())
+            mismatchOutput = open(getMismatchPath(self.outputFile), 'a')
+            for i, j, halMrca, reconciledMrca, outcome in mismatches:
+                entry1 = eligibleLeaves[i][1]
+                entry2 = eligibleLeaves[j][1]
+                mismatchOutput.write("mismatch\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n" % (entry1.genome, entry1.seq, entry1.pos, entry2.genome, entry2.seq, entry2.pos, self.speciesTree.genomes[halMrca], self.speciesTree.genomes[reconciledMrca], OUTCOMES[outcome], halNewick, reconciledNewick))
+            mismatchOutput.close()
+
+        # Keep the column's counts as (record, count) increments until
+        # the job's count table is written.
+        increments = array(RECORD_TYPECODE)
+        allPairsCounts = self.allPairsCounts.counts
+        for record, count in enumerate(counts):
+            if count != 0:
+                increments.append(record)
+                increments.append(count)
+                allPairsCounts[record] += count
+        output = open(getPendingCountsPath(self.outputFile), 'ab')
+        increments.tofile(output)
+        output.close()
 
 class CoalescenceResults:
     # Can't use namedtuple since tuples are immutable
     def __init__(self, identical=0, early=0, late=0):
-        self.identical = 0
-        self.early = 0
-        self.late = 0
+        self.identical = identical
+        self.early = early
+        self.late = late
 
-def defaultCoalescenceResults():
-    return CoalescenceResults(0, 0, 0)
+    def add(self, other):
+        self.identical += other.identical
+        self.early += other.early
+        self.late += other.late
+
+class MergeOutputs(Target):
+    """Merge a group of job outputs and partial count tables into a
+    single partial count table (and mismatch file)."""
+    def __init__(self, opts, recordFiles, countFiles, outputFile, speciesTree):
+        Target.__init__(self)
+        self.opts = opts
+        self.recordFiles = recordFiles
+        self.countFiles = countFiles
+        self.outputFile = outputFile
+        self.speciesTree = speciesTree
+
+    def run(self):
+        counts = CoalescenceCounts(self.speciesTree.genomes)
+        mismatchPath = None
+        if self.opts.writeMismatchesToFile is not None:
+            mismatchPath = getMismatchPath(self.outputFile)
+        costsPath = None
+        if self.opts.costReport is not None:
+            costsPath = getCostsPath(self.outputFile)
+        mergeOutputs(counts, self.recordFiles, self.countFiles, mismatchPath, costsPath,
+                     getStatsPath(self.outputFile))
+        counts.writeCounts(self.outputFile)
+
+class ReduceOutputs(Target):
+    """Merge the job outputs in a tree of MergeOutputs targets, each
+    merging at most --summarizeFanIn inputs, until few enough are left
+    for Summarize to merge."""
+    def __init__(self, opts, recordFiles, countFiles, speciesTree):
+        Target.__init__(self)
+        self.opts = opts
+        self.recordFiles = recordFiles
+        self.countFiles = countFiles
+        self.speciesTree = speciesTree
+
+    def run(self):
+        inputs = [(path, False) for path in self.recordFiles] + [(path, True) for path in self.countFiles]
+        fanIn = max(self.opts.summarizeFanIn, 2)
+        if len(inputs) <= fanIn:
+            self.setFollowOnTarget(Summarize(self.opts, self.recordFiles, self.opts.outputFile,
+                                             self.opts.writeMismatchesToFile, self.speciesTree,
+                                             self.countFiles))
+            return
+        partials = []
+        for groupStart in xrange(0, len(inputs), fanIn):
+            group = inputs[groupStart:groupStart + fanIn]
+            partial = getTempFile(rootDir=self.getGlobalTempDir())
+            partials.append(partial)
+            self.addChildTarget(MergeOutputs(self.opts,
+                                             [path for path, isCounts in group if not isCounts],
+                                             [path for path, isCounts in group if isCounts],
+                                             partial, self.speciesTree))
+        self.setFollowOnTarget(ReduceOutputs(self.opts, [], partials, self.speciesTree))
 
 class Summarize(Target):
-    """Merge the many output files into one large output file."""
-    def __init__(self, opts, outputs, outputFile, mismatchPath):
+    """Merge the job outputs (or partially-merged count tables) into
+    one large output file."""
+    def __init__(self, opts, outputs, outputFile, mismatchPath, speciesTree, countFiles=None,
+                 samplingPrecision=None):
         Target.__init__(self)
         self.opts = opts
         self.outputs = outputs
         self.outputFile = outputFile
         self.mismatchPath = mismatchPath
+        self.speciesTree = speciesTree
+        if countFiles is None:
+            countFiles = []
+        self.countFiles = countFiles
+        # (target CI, achieved CI, columns scheduled, waves) if
+        # sampling adaptively
+        self.samplingPrecision = samplingPrecision
 
     def run(self):
-        mismatchFile = None
-        if self.mismatchPath is not None:
-            mismatchFile = open(self.mismatchPath, 'w')
-        results = defaultdict(lambda: defaultdict(defaultCoalescenceResults))
-        results["aggregate"] = defaultCoalescenceResults()
-        for output in self.outputs:
-            for line in open(output):
-                if line.strip() == "":
-                    # blank line
-                    continue
-                fields = line.strip().split("\t")
-                reportType = fields[0]
-                fields = fields[1:]
-                if reportType == "coalescence":
-                    genome1 = fields[0]
-                    seq1 = fields[1]
-                    pos1 = fields[2]
-                    genome2 = fields[3]
-                    seq2 = fields[4]
-                    pos2 = fields[5]
-                    result = fields[6]
-                    if result == "identical":
-                        results["aggregate"].identical += 1
-                        results[genome1]["aggregate"].identical += 1
-                        results[genome2]["aggregate"].identical += 1
-                        results[genome1][genome2].identical += 1
-                        results[genome2][genome1].identical += 1
-                    elif result == "early":
-                        results["aggregate"].early += 1
-                        results[genome1]["aggregate"].early += 1
-                        results[genome2]["aggregate"].early += 1
-                        results[genome1][genome2].early += 1
-                        results[genome2][genome1].early += 1
-                    else:
-                        assert result == "late"
-                        results["aggregate"].late += 1
-                        results[genome1]["aggregate"].late += 1
-                        results[genome2]["aggregate"].late += 1
-                        results[genome2][genome1].late += 1
-                        results[genome1][genome2].late += 1
-                else:
-                    print "\"%s\"" % reportType
-                    print "%s" % line
-                    assert reportType == "mismatch"
-                    mismatchFile.write(line)
+        counts = CoalescenceCounts(self.speciesTree.genomes)
+        statsPath = getTempFile(rootDir=self.getLocalTempDir())
+        mergeOutputs(counts, self.outputs, self.countFiles, self.mismatchPath, self.opts.costReport,
+                     statsPath)
+        if self.opts.prefilterStats is not None:
+            # Include the columns that were never scheduled.
+            statsFile = open(statsPath, 'a')
+            for line in open(self.opts.prefilterStats):
+                statsFile.write(line)
+            statsFile.close()
+        columnStats = [parseColumnStats(line) for line in open(statsPath)]
+        if self.opts.columnStats is not None:
+            statsFile = open(self.opts.columnStats, 'w')
+            statsFile.write(COLUMN_STATS_HEADER)
+            for line in open(statsPath):
+                statsFile.write(line)
+            statsFile.close()
+        self.writeResults(counts, columnStats)
+
+    def writeResults(self, counts, columnStats):
+        genomeIds = range(len(counts.genomes))
+        pairResults = {}
+        for genomeId1 in genomeIds:
+            for genomeId2 in genomeIds:
+                results = counts.getPairResults(genomeId1, genomeId2)
+                if results.identical + results.early + results.late != 0:
+                    pairResults[(genomeId1, genomeId2)] = results
         with open(self.outputFile, 'w') as outputFile:
             outputFile.write('<coalescenceTest file="%s">\n' % (self.opts.halFile))
-            self.printAggregateResults(outputFile, results["aggregate"])
-            for genome1 in results.keys():
-                if genome1 == "aggregate":
+            self.printAggregateResults(outputFile, counts.getAggregateResults())
+            if self.samplingPrecision is not None:
+                outputFile.write('<samplingPrecision targetCI="%f" achievedCI="%f" numColumns="%d" numWaves="%d" />\n' % self.samplingPrecision)
+            for genomeId1 in genomeIds:
+                genome1Pairs = [genomeId2 for genomeId2 in genomeIds if (genomeId1, genomeId2) in pairResults]
+                if len(genome1Pairs) == 0:
                     continue
-                outputFile.write('<genomeCoalescenceTest genome="%s">\n' % (genome1))
-                self.printAggregateResults(outputFile, results[genome1]["aggregate"])
-                for genome2 in results[genome1]:
-                    if genome2 == "aggregate":
-                        continue
-                    self.printGenomeResults(outputFile, genome1, genome2, results[genome1][genome2])
+                genome1Aggregate = counts.getGenomeResults(genomeId1)
+                outputFile.write('<genomeCoalescenceTest genome="%s">\n' % (counts.genomes[genomeId1]))
+                self.printAggregateResults(outputFile, genome1Aggregate)
+                for genomeId2 in genome1Pairs:
+                    self.printGenomeResults(outputFile, counts.genomes[genomeId1], counts.genomes[genomeId2], pairResults[(genomeId1, genomeId2)])
                 outputFile.write('</genomeCoalescenceTest>\n')
+            if self.opts.xmlColumnStats:
+                # Timings differ from run to run, so this would make
+                # otherwise identical outputs differ.
+                self.printColumnStatistics(outputFile, columnStats)
             outputFile.write('</coalescenceTest>\n')
 
+    def printColumnStatistics(self, outputFile, columnStats):
+        """Write the totals and histograms of the per-column statistics."""
+        statusCounts = Counter(stats.status for stats in columnStats)
+        outputFile.write('<columnStatistics columns="%d" scored="%d" cached="%d">\n' % (len(columnStats), statusCounts['scored'], sum(1 for stats in columnStats if stats.cached)))
+        for reason in SKIP_REASONS:
+            outputFile.write('<skippedColumns reason="%s" count="%d" />\n' % (reason, statusCounts[reason]))
+        for stage in STAGES:
+            wallTimes = [stats.wallTimes[stage] for stats in columnStats if stage in stats.wallTimes]
+            if len(wallTimes) == 0:
+                continue
+            cpuTimes = [stats.cpuTimes[stage] for stats in columnStats if stage in stats.cpuTimes]
+            maxRSSs = [stats.maxRSS[stage] for stats in columnStats if stage in stats.maxRSS]
+            outputFile.write('<stageStatistics stage="%s" columns="%d" totalWallTime="%f" meanWallTime="%f" maxWallTime="%f" totalCpuTime="%f" maxRSS="%d">\n' % (stage, len(wallTimes), sum(wallTimes), sum(wallTimes) / len(wallTimes), max(wallTimes), sum(cpuTimes), max(maxRSSs) if len(maxRSSs) != 0 else 0))
+            self.printHistogram(outputFile, wallTimes)
+            outputFile.write('</stageStatistics>\n')
+        for name, values in [('numSequences', [stats.numSequences for stats in columnStats]),
+                             ('alignmentLength', [stats.alignmentLength for stats in columnStats]),
+                             ('peakRSS', [stats.getPeakRSS() for stats in columnStats])]:
+            values = [value for value in values if value is not None]
+            if len(values) == 0:
+                continue
+            outputFile.write('<distribution name="%s" columns="%d" mean="%f" max="%d">\n' % (name, len(values), float(sum(values)) / len(values), max(values)))
+            self.printHistogram(outputFile, values)
+            outputFile.write('</distribution>\n')
+        outputFile.write('</columnStatistics>\n')
+
+    def printHistogram(self, outputFile, values):
+        for binMin, binMax, count in getLog2Histogram(values):
+            outputFile.write('<bin min="%g" max="%g" count="%d" />\n' % (binMin, binMax, count))
+
     def printAggregateResults(self, outputFile, results):
         total = results.identical + results.early + results.late
         if total == 0:
@@ -402,38 +1803,129 @@ class Summarize(Target):
 if __name__ == '__main__':
     from scoreHalPhylogenies import * # required for jobTree
     parser = ArgumentParser(description=__doc__)
-    Stack.addJobTreeOptions(parser)
-    parser.add_argument('halFile', help='hal file')
+    if Stack is not None:
+        Stack.addJobTreeOptions(parser)
+    parser.add_argument('halFile', help='hal file, or a comma-separated list'
+                        ' of hal files to score in the same run (on the same'
+                        ' sampled positions). Then outputFile, --costReport,'
+                        ' --columnStats and --writeMismatchesToFile take one'
+                        ' comma-separated path per hal file')
     parser.add_argument('refGenome', help='reference genome')
     parser.add_argument('outputFile', help='output XML file')
     parser.add_argument('--numSamples', type=int,
                         help='Number of columns to sample',
                         default=50000)
+    parser.add_argument('--targetCI', type=float,
+                        help='sample in waves of --waveSize columns, stopping'
+                        ' (before --numSamples) once the 95%% confidence'
+                        ' intervals of the identical/early/late fractions'
+                        ' have at most this half-width (not with --allPairs)')
+    parser.add_argument('--waveSize', type=int,
+                        help='Number of columns to sample per wave when'
+                        ' using --targetCI',
+                        default=5000)
+    parser.add_argument('--perGenomeCI', action='store_true', default=False,
+                        help='with --targetCI, also require each genome\'s'
+                        ' fractions to reach the target precision')
+    parser.add_argument('--sampleBed',
+                        help='only sample reference positions within the'
+                        ' regions of this BED file (positions in several'
+                        ' overlapping regions are weighted accordingly)')
     parser.add_argument('--nonDuplicated', action='store_true',
                         help='remove only-duplicated restriction on coalescence pairs',
                         default=False)
     parser.add_argument('--samplesPerJob', type=int,
                         help='Number of samples per jobTree job',
                         default=100)
+    parser.add_argument('--summarizeFanIn', type=int,
+                        help='Maximum number of job outputs merged by each'
+                        ' target in the final reduction',
+                        default=20)
+    parser.add_argument('--packByCost', action='store_true', default=False,
+                        help='predict the cost of each column from its number'
+                        ' of sequences, and pack the columns into jobs of'
+                        ' roughly equal total cost (instead of equal numbers'
+                        ' of columns)')
+    parser.add_argument('--costReport', help='write the predicted and actual'
+                        ' cost (in seconds) of every column to this TSV, with'
+                        ' columns sequence, position, job, predicted cost,'
+                        ' actual cost')
+    parser.add_argument('--columnStats', help='write the outcome, size, and'
+                        ' time, CPU time and peak RSS (in KB) of each stage'
+                        ' of every column to this TSV')
+    parser.add_argument('--xmlColumnStats', action='store_true', default=False,
+                        help='add totals and histograms of the per-column'
+                        ' statistics (as in --columnStats) to the output XML.'
+                        ' They include timings, so the XML is no longer the'
+                        ' same from run to run')
     parser.add_argument('--coalescencesPerSample', type=int,
                         help='maximum number of coalescences to sample per column',
                         default=10)
     parser.add_argument('--onlySelf', default=False, action='store_true',
                         help='only sample coalescences including the sampled position')
+    parser.add_argument('--allPairs', default=False, action='store_true',
+                        help='score every eligible pair of sequences in each'
+                        ' column, instead of sampling --coalescencesPerSample'
+                        ' of them')
+    parser.add_argument('--workersPerJob', type=int,
+                        help='Number of columns to align, estimate trees for'
+                        ' and reconcile at once within each job',
+                        default=1)
     parser.add_argument('--width', type=int,
                         help='Width of region to extract around the'
                         ' sampled columns',  default=500)
     parser.add_argument('--alignerCommand', help='alignment command to run,'
                         ' where "INPUT" will be replaced with the input path'
-                        ' and "OUTPUT" will be replaced with the output path',
-                        default='mafft INPUT > OUTPUT')
+                        ' and "OUTPUT" will be replaced with the output path.'
+                        ' If either is missing, the input is piped to stdin'
+                        ' or the output is read from stdout, respectively',
+                        default='mafft INPUT')
     parser.add_argument('--estimatorCommand', help='tree-estimation command to run,'
                         ' where "INPUT" will be replaced with the input path'
-                        ' and "OUTPUT" will be replaced with the output path',
-                        default='fasttree -nt -gtr < INPUT > OUTPUT')
+                        ' and "OUTPUT" will be replaced with the output path.'
+                        ' If either is missing, the input is piped to stdin'
+                        ' or the output is read from stdout, respectively',
+                        default='fasttree -nt -gtr')
+    parser.add_argument('--columnTempDir', help='directory (ideally node-local,'
+                        ' e.g. /dev/shm) for the per-column temporary files of'
+                        ' commands that need INPUT/OUTPUT paths (default: the'
+                        ' job\'s local temp dir)')
+    parser.add_argument('--reconcileInProcess', action='store_true', default=False,
+                        help='reconcile in-process (see reconciliation.py)'
+                        ' instead of with the external reconcile binary')
+    parser.add_argument('--cacheDir', help='directory to cache each column\'s'
+                        ' hal tree, alignment and reconciled tree in, so that'
+                        ' reruns on the same hal file with different scoring'
+                        ' options (or after a failure) can skip them')
+    parser.add_argument('--cacheMaxSize', type=float,
+                        help='Maximum size of the column cache, in GB (least'
+                        ' recently used columns are evicted first)',
+                        default=10.0)
+    parser.add_argument('--local', action='store_true', default=False,
+                        help='run on this machine using --cores processes'
+                        ' instead of through jobTree')
+    parser.add_argument('--cores', type=int,
+                        help='Number of processes to use with --local',
+                        default=1)
+    parser.add_argument('--seed', type=int,
+                        help='random seed, for output that is reproducible'
+                        ' regardless of how the jobs are scheduled or retried')
     parser.add_argument('--writeMismatchesToFile',
                         help="write trees to this file when at least one of "
                         "the sampled coalescences don't match")
 
     opts = parser.parse_args()
-    Stack(Setup(opts)).startJobTree(opts)
+    try:
+        splitHalOpts(opts)
+    except ValueError as e:
+        parser.error(str(e))
+    if opts.targetCI is not None and opts.allPairs:
+        # The pairs in a column aren't independent, so a confidence
+        # interval that treats them as such would be far too narrow.
+        parser.error("--targetCI can't be used with --allPairs")
+    if opts.local:
+        runLocally(Setup(opts), opts.cores)
+    else:
+        if Stack is None:
+            parser.error("jobTree isn't installed; use --local")
+        Stack(Setup(opts)).startJobTree(opts)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+"""Tests for scoreHalPhylogenies.py, run against stand-ins for the hal
+tools and the aligner/estimator."""
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from array import array
+
+from scoreHalPhylogenies import OUTCOMES, RECORD_TYPECODE, CoalescenceCounts, ColumnCommitLog, ColumnStats, \
+    encodeCoalescenceRecord, getAchievedCI, getMismatchPath, getWilsonHalfWidth, mergeOutputs, truncateFile
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scoreHalPhylogenies.py")
+
+HAL_STATS = """
+import sys
+if sys.argv[1] == '--tree':
+    print '((h,c)hc,g)hcg;'
+else:
+    print 'c\\t900000'
+    print 'd\\t500000'
+"""
+
+# Columns alternate between duplicated in h and not; the tree given is
+# the truth, so the estimator's trees are the ones that get scored.
+GET_REGION = """
+import sys
+args = sys.argv
+for line in open(args[args.index('--positionsFile') + 1]):
+    seq, pos = line.split()
+    pos = int(pos)
+    names = ['h.%s|%d' % (seq, pos), 'c.c|3', 'g.c|5']
+    if pos % 2 == 0:
+        names += ['h.%s|%d' % (seq, pos + 1000000), 'c.c|4']
+    if '--membersOnly' in args:
+        counts = {}
+        for name in names:
+            counts[name[0]] = counts.get(name[0], 0) + 1
+        print '%s\\t%d\\t%s\\t%s' % (seq, pos, ','.join('%s=%d' % kv for kv in sorted(counts.items())),
+                                   ','.join(name[2:] for name in names if name[0] == 'h'))
+    else:
+        if pos % 2 == 0:
+            print '#((%s,%s)hc.c|0,(%s,%s)hc.c|1,%s)hcg.c|0' % (names[0], names[1], names[3], names[4], names[2])
+        else:
+            print '#((%s,%s)hc.c|0,%s)hcg.c|0' % (names[0], names[1], names[2])
+        for name in names:
+            print '>%s\\nACGT' % name
+"""
+
+# A random (but deterministic for a given column) tree, so that the
+# column results differ.
+ESTIMATOR = """
+import random, sys
+names = [line[1:].strip() for line in sys.stdin if line.startswith('>')]
+random.seed(','.join(names))
+random.shuffle(names)
+tree = names[0]
+for name in names[1:]:
+    tree = '(%s,%s)' % (tree, name)
+print tree + ';'
+"""
+
+class SeededRunTest(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        binDir = os.path.join(self.tempDir, "bin")
+        os.mkdir(binDir)
+        for name, source in [("halStats", HAL_STATS),
+                             ("getRegionAroundSampledColumn", GET_REGION),
+                             ("fakeEstimator", ESTIMATOR)]:
+            path = os.path.join(binDir, name)
+            scriptFile = open(path, 'w')
+            scriptFile.write("#!%s\n%s" % (sys.executable, source))
+            scriptFile.close()
+            os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+        self.env = dict(os.environ, PATH=binDir + os.pathsep + os.environ["PATH"])
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def score(self, name, extraArgs):
+        outputPath = os.path.join(self.tempDir, name + ".xml")
+        subprocess.check_call([sys.executable, SCRIPT, "--local", "--seed", "7",
+                               "--numSamples", "60", "--samplesPerJob", "7",
+                               "--alignerCommand", "cat", "--estimatorCommand", "fakeEstimator",
+                               "--reconcileInProcess",
+                               "--columnStats", os.path.join(self.tempDir, name + ".tsv"),
+                               "test.hal", "h", outputPath] + extraArgs,
+                              env=self.env, cwd=self.tempDir)
+        return open(outputPath).read()
+
+    def testSeededRunsGiveIdenticalXML(self):
+        """Two runs with the same seed give byte-identical XML, however
+        many cores they use."""
+        first = self.score("first", ["--cores", "1"])
+        second = self.score("second", ["--cores", "3"])
+        self.assertTrue("<coalescenceTest" in first)
+        self.assertEqual(first, second)
+
+    def testXMLColumnStatsAreOptIn(self):
+        self.assertFalse("<columnStatistics" in self.score("default", []))
+        self.assertTrue("<columnStatistics" in self.score("withStats", ["--xmlColumnStats"]))
+
+class CoalescenceCountsTest(unittest.TestCase):
+    def setUp(self):
+        self.counts = CoalescenceCounts(['h', 'c'])
+        for genome1, genome2, outcome, count in [(0, 0, 'identical', 20), (0, 0, 'late', 20),
+                                                 (0, 1, 'early', 5), (1, 1, 'identical', 55)]:
+            record = encodeCoalescenceRecord(genome1, genome2, OUTCOMES.index(outcome), 2)
+            self.counts.counts[record] += count
+
+    def testGenomeResults(self):
+        results = self.counts.getGenomeResults(0)
+        self.assertEqual((results.identical, results.early, results.late), (40, 5, 40))
+        results = self.counts.getGenomeResults(0, countSameGenomeOnce=True)
+        self.assertEqual((results.identical, results.early, results.late), (20, 5, 20))
+
+    def testPerGenomeCICountsPairsOnce(self):
+        """h's 45 coalescences give a wider interval than the 85 that
+        double-counting its within-genome pairs would claim."""
+        self.assertEqual(getAchievedCI(self.counts, True), getWilsonHalfWidth(20, 45))
+        self.assertEqual(getAchievedCI(self.counts, False), getWilsonHalfWidth(75, 100))
+
+class ColumnCommitLogTest(unittest.TestCase):
+    NUM_COLUMNS = 10
+
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def scoreColumn(self, outputFile, commitLog, i):
+        """Write a column's records and mismatches the way ScoreColumns
+        does, then commit it."""
+        mismatchFile = open(getMismatchPath(outputFile), 'a')
+        mismatchFile.write("mismatch\tcolumn %d\n" % i)
+        mismatchFile.close()
+        outputHandle = open(outputFile, 'ab')
+        array(RECORD_TYPECODE, [i % 12] * (i + 1)).tofile(outputHandle)
+        outputHandle.close()
+        commitLog.commit(0.0, ColumnStats(("c", i)))
+
+    def merge(self, outputFile):
+        """Get the merged counts and mismatches of a job's output."""
+        counts = CoalescenceCounts(['h', 'c'])
+        mismatchPath = os.path.join(self.tempDir, "merged.mismatches")
+        mergeOutputs(counts, [outputFile], [], mismatchPath)
+        return counts.counts, open(mismatchPath).read()
+
+    def testRecoveryMatchesUninterruptedRun(self):
+        uninterrupted = os.path.join(self.tempDir, "uninterrupted")
+        commitLog = ColumnCommitLog(uninterrupted, uninterrupted)
+        self.assertEqual(commitLog.recover(), [])
+        for i in xrange(self.NUM_COLUMNS):
+            self.scoreColumn(uninterrupted, commitLog, i)
+        commitLog.flush()
+
+        interrupted = os.path.join(self.tempDir, "interrupted")
+        commitLog = ColumnCommitLog(interrupted, interrupted)
+        commitLog.recover()
+        for i in xrange(6):
+            self.scoreColumn(interrupted, commitLog, i)
+        commitLog.flush()
+        # Kill the job partway through committing column 6 (so the
+        # log ends mid-line) and writing column 7 (so the records and
+        # mismatches end mid-record).
+        self.scoreColumn(interrupted, commitLog, 6)
+        commitLog.flush()
+        truncateFile(commitLog.path, os.path.getsize(commitLog.path) - 3)
+        for path in [interrupted, getMismatchPath(interrupted)]:
+            open(path, 'ab').write("\x07\x00")
+
+        # The retry only redoes the columns that weren't committed.
+        commitLog = ColumnCommitLog(interrupted, interrupted)
+        committed = [stats.position for _, stats in commitLog.recover()]
+        self.assertEqual(committed, [("c", i) for i in xrange(6)])
+        for i in xrange(6, self.NUM_COLUMNS):
+            self.scoreColumn(interrupted, commitLog, i)
+        commitLog.flush()
+        self.assertEqual(self.merge(interrupted), self.merge(uninterrupted))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -25,11 +25,10 @@ twoBitInfo ${QUERYFILE} ${TEMPDIR}/query.chrom.sizes
 # Chain
 axtChain -linearGap=loose ${TEMPDIR}/lastzLocal ${TARGETFILE} ${QUERYFILE} ${TEMPDIR}/chain
 
-# Filter by query coverage
-/cluster/home/jcarmstr/znfChainTests/filterChainsByCoverage.py ${TEMPDIR}/chain ${MINCOVERAGE} > ${TEMPDIR}/filteredChains
-# Filter so that the chains are relatively compact (have no large
-# target gaps). Could also potentially filter using -tMaxSize.
-chainFilter -tMaxGap=2000 ${TEMPDIR}/filteredChains > ${TEMPDIR}/compactChains
+# Filter by query coverage, and so that the chains are relatively
+# compact (have no large target gaps), in one pass. Could also
+# potentially filter using -tMaxSize.
+"$(dirname "$0")"/filterChains.py --minCoverage ${MINCOVERAGE} --tMaxGap 2000 ${TEMPDIR}/chain > ${TEMPDIR}/compactChains
 
 # Build bed file of all candidate genes in target
 chainToPsl ${TEMPDIR}/compactChains /hive/data/genomes/${TARGETGENOME}/chrom.sizes ${TEMPDIR}/query.chrom.sizes ${TARGETFILE} ${QUERYFILE} ${TEMPDIR}/filtered.psl
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""Filter chain files in one pass: keep only the chains that cover more
+than --minCoverage percent of their query, have no target gaps longer
+than --tMaxGap (like chainFilter -tMaxGap), and, with --bestPerQuery,
+are the best-scoring remaining chain for their query within their file.
+
+Only the header fields and running totals of each chain are kept while
+reading; the chains that pass are copied out of the file by offset, so
+memory use doesn't grow with the size of the chain files. Several
+chain files are filtered in parallel."""
+from argparse import ArgumentParser
+from collections import namedtuple
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+
+# A chain's header fields, the byte range it occupies in its file, and
+# totals over its blocks.
+Chain = namedtuple('Chain', ['score', 'qName', 'qSize', 'start', 'end',
+                             'alignedLength', 'maxTGap'])
+
+def scanChains(chainFile, commentHandler):
+    """Generate the Chains in a chain file, in order. Comment lines are
+    passed to commentHandler."""
+    offset = 0
+    header = None
+    start = 0
+    end = 0
+    alignedLength = 0
+    maxTGap = 0
+    while True:
+        line = chainFile.readline()
+        if line == '':
+            break
+        lineStart = offset
+        offset += len(line)
+        if line[0] == '#':
+            commentHandler(line)
+            continue
+        fields = line.split()
+        if len(fields) == 0:
+            continue
+        if fields[0] == 'chain':
+            if header is not None:
+                yield Chain(int(header[1]), header[7], int(header[8]), start, end,
+                            alignedLength, maxTGap)
+            header = fields
+            start = lineStart
+            alignedLength = 0
+            maxTGap = 0
+        else:
+            # Blocks are "size [tGap qGap]"; the last has no gaps.
+            alignedLength += int(fields[0])
+            if len(fields) > 1:
+                maxTGap = max(maxTGap, int(fields[1]))
+        end = offset
+    if header is not None:
+        yield Chain(int(header[1]), header[7], int(header[8]), start, end,
+                    alignedLength, maxTGap)
+
+def passesFilters(chain, minCoverage, tMaxGap):
+    if 100 * float(chain.alignedLength) / chain.qSize <= minCoverage:
+        return False
+    return tMaxGap is None or chain.maxTGap <= tMaxGap
+
+def copyChain(chainFile, chain, output):
+    """Copy a chain (followed by a blank line) from chainFile to output."""
+    chainFile.seek(chain.start)
+    text = chainFile.read(chain.end - chain.start).rstrip("\n")
+    output.write(text + "\n\n")
+
+def filterChains(chainPath, output, minCoverage, tMaxGap=None, bestPerQuery=False):
+    """Write the chains in chainPath that pass the filters to output."""
+    chainFile = open(chainPath)
+    # A second handle to copy the passing chains from, since the first
+    # is still being read.
+    copyFile = open(chainPath)
+    bestChains = {}
+    for chain in scanChains(chainFile, output.write):
+        if not passesFilters(chain, minCoverage, tMaxGap):
+            continue
+        if not bestPerQuery:
+            copyChain(copyFile, chain, output)
+        elif chain.qName not in bestChains or bestChains[chain.qName].score < chain.score:
+            bestChains[chain.qName] = chain
+    # Output the best chains in the order they appear in the file.
+    for chain in sorted(bestChains.values(), key=lambda chain: chain.start):
+        copyChain(copyFile, chain, output)
+    chainFile.close()
+    copyFile.close()
+
+def filterChainsToFile(args):
+    """Filter a chain file into outputPath (for running in a process
+    pool)."""
+    chainPath, outputPath, minCoverage, tMaxGap, bestPerQuery = args
+    output = open(outputPath, 'w')
+    filterChains(chainPath, output, minCoverage, tMaxGap, bestPerQuery)
+    output.close()
+    return outputPath
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('chainFiles', nargs='+', help='chain files to filter')
+    parser.add_argument('--minCoverage', type=float, default=0.0,
+                        help='minimum percentage of the query covered by'
+                        ' aligned bases (exclusive)')
+    parser.add_argument('--tMaxGap', type=int,
+                        help='maximum size of any gap in the target')
+    parser.add_argument('--bestPerQuery', action='store_true', default=False,
+                        help='only keep the highest-scoring chain for each'
+                        ' query sequence in each file')
+    parser.add_argument('--outputDir',
+                        help='write each file\'s chains to a file with the same'
+                        ' name in this directory, instead of all of them to'
+                        ' stdout')
+    parser.add_argument('--numProcesses', type=int, default=1,
+                        help='number of chain files to filter at once')
+    opts = parser.parse_args()
+
+    tempDir = None
+    pool = None
+    if opts.outputDir is not None:
+        outputPaths = [os.path.join(opts.outputDir, os.path.basename(path)) for path in opts.chainFiles]
+    else:
+        tempDir = tempfile.mkdtemp()
+        outputPaths = [os.path.join(tempDir, str(i)) for i in xrange(len(opts.chainFiles))]
+    jobs = [(chainPath, outputPath, opts.minCoverage, opts.tMaxGap, opts.bestPerQuery)
+            for chainPath, outputPath in zip(opts.chainFiles, outputPaths)]
+    try:
+        if opts.numProcesses > 1 and len(jobs) > 1:
+            pool = multiprocessing.Pool(opts.numProcesses)
+            results = pool.imap(filterChainsToFile, jobs)
+        else:
+            results = (filterChainsToFile(job) for job in jobs)
+        for outputPath in results:
+            if tempDir is not None:
+                # Output the files in order, as each finishes.
+                shutil.copyfileobj(open(outputPath), sys.stdout)
+                os.remove(outputPath)
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if tempDir is not None:
+            shutil.rmtree(tempDir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
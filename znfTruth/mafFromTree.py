@@ -0,0 +1,149 @@
+"""Writing a single-block MAF from a tree and an aligned fasta file with
+a sequence for each leaf, without loading the alignment into memory.
+
+The fasta is memory-mapped and its sequences found through a .fai
+index (as written by samtools faidx), which is built next to the fasta
+if it's missing or out of date."""
+import mmap
+import os
+
+class IndexedFasta:
+    """Random access to the sequences of a fasta file with lines of
+    equal length (within each sequence), via a .fai index."""
+    def __init__(self, path):
+        self.path = path
+        indexPath = path + ".fai"
+        if os.path.exists(indexPath) and os.path.getmtime(indexPath) >= os.path.getmtime(path):
+            entries = readFastaIndex(indexPath)
+        else:
+            entries = buildFastaIndex(path)
+            try:
+                writeFastaIndex(entries, indexPath)
+            except IOError:
+                # The index is only a cache, so it's fine to keep it in
+                # memory if the fasta's directory isn't writable.
+                pass
+        self.index = dict(entries)
+        self.fileHandle = open(path, 'rb')
+        if os.path.getsize(path) != 0:
+            self.mmap = mmap.mmap(self.fileHandle.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.mmap = ""
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def getPieces(self, name):
+        """Generate the sequence as a series of strings (one per line
+        in the file)."""
+        length, offset, lineBases, lineBytes = self.index[name]
+        if length == 0:
+            return
+        for lineStart in xrange(0, length, lineBases):
+            start = offset + (lineStart / lineBases) * lineBytes
+            yield self.mmap[start:start + min(lineBases, length - lineStart)]
+
+    def countUngapped(self, name):
+        """Get the number of bases in a sequence, not counting gaps."""
+        length = self.index[name][0]
+        return length - sum(piece.count('-') for piece in self.getPieces(name))
+
+def readFastaIndex(indexPath):
+    """Read a .fai index into a list of (name, (length, offset of the
+    first base, bases per line, bytes per line))."""
+    entries = []
+    for line in open(indexPath):
+        fields = line.split("\t")
+        if len(fields) < 5:
+            continue
+        entries.append((fields[0], tuple(int(field) for field in fields[1:5])))
+    return entries
+
+def buildFastaIndex(path):
+    """Build the .fai index entries of a fasta file (see
+    readFastaIndex). Like samtools, sequences are named by the first
+    word of their headers."""
+    entries = []
+    names = set()
+    fastaFile = open(path, 'rb')
+    offset = 0
+    name = None
+
+    def finishSequence():
+        if name is None:
+            return
+        if name in names:
+            raise RuntimeError("Sequence %s appears more than once in %s" % (name, path))
+        names.add(name)
+        entries.append((name, (length, sequenceOffset, lineBases or 0, lineBytes or 0)))
+
+    for line in fastaFile:
+        lineStart = offset
+        offset += len(line)
+        if line.startswith(">"):
+            finishSequence()
+            headerWords = line[1:].split()
+            name = headerWords[0] if len(headerWords) != 0 else ""
+            sequenceOffset = offset
+            length = 0
+            lineBases = None
+            lineBytes = None
+            # Set once a line shorter than the first has been seen,
+            # since only the last line may be.
+            sawShortLine = False
+            continue
+        bases = len(line.rstrip("\r\n"))
+        if name is None:
+            continue
+        if bases == 0:
+            # Only allowed after the last line of a sequence.
+            sawShortLine = lineBases is not None
+            continue
+        if sawShortLine or (lineBases is not None and bases > lineBases):
+            raise RuntimeError("Sequence %s in %s has lines of different lengths, so it can't be "
+                               "indexed (line at byte %d)" % (name, path, lineStart))
+        if lineBases is None:
+            lineBases = bases
+            lineBytes = len(line)
+        elif bases < lineBases:
+            sawShortLine = True
+        length += bases
+    finishSequence()
+    fastaFile.close()
+    return entries
+
+def writeFastaIndex(entries, indexPath):
+    indexFile = open(indexPath, 'w')
+    for name, (length, offset, lineBases, lineBytes) in entries:
+        indexFile.write("%s\t%d\t%d\t%d\t%d\n" % (name, length, offset, lineBases, lineBytes))
+    indexFile.close()
+
+def readChromSizes(path):
+    """Get a dict of sequence name -> length from a chrom.sizes file."""
+    chromSizes = {}
+    for line in open(path):
+        fields = line.split()
+        if len(fields) < 2:
+            continue
+        chromSizes[fields[0]] = int(fields[1])
+    return chromSizes
+
+def writeMafFromTree(output, tree, treeString, fasta, getRowInfo):
+    """Write a MAF block with a row for each leaf of a CompactTree, in
+    post-order, taking the aligned sequences from an IndexedFasta.
+    getRowInfo(leaf name, ungapped length) gives each row's (source
+    name, start, strand, source size)."""
+    output.write('##maf version=1 scoring=NA\n')
+    output.write('a tree="%s"\n' % (treeString))
+    for nodeId in tree.leafIds:
+        nodeName = tree.getName(nodeId)
+        if nodeName not in fasta:
+            raise RuntimeError("The tree has a node %s which was not found in the fasta file" % (nodeName))
+        alignedLen = fasta.countUngapped(nodeName)
+        name, start, strand, srcSize = getRowInfo(nodeName, alignedLen)
+        output.write('s %s %s %d %s %d ' % (name, start, alignedLen, strand, srcSize))
+        for piece in fasta.getPieces(nodeName):
+            output.write(piece)
+        output.write('\n')
+    # mafValidator wants an empty closing line(?)
+    output.write('\n')
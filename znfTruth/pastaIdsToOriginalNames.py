@@ -1,24 +1,15 @@
 #!/usr/bin/env python
 # Usage: pastaIdsToOriginalNames.py fastaFile renameFile
 import sys
-from sonLib.bioio import system, fastaRead, fastaWrite
+from sonLib.bioio import fastaRead, fastaWrite
+from pastaNames import readTranslateFile, getSafeName
 
 fastaFile = sys.argv[1]
 renameFile = sys.argv[2]
 
-curRealName = None
-curPastaID = None
-translate = {}
-for i, line in enumerate(open(renameFile)):
-    line = line.strip()
-    if i % 3 == 0:
-        curPastaID = line
-    elif i % 3 == 1:
-        curRealName = line
-    else:
-        translate[curPastaID] = curRealName
+translate = readTranslateFile(renameFile)
 
 for header, seq in fastaRead(open(fastaFile)):
     # hacks for if we are using the badly-named original fasta.
-    header = translate[header].replace("...", ".-.").replace(".", "_").replace("__", "_")
+    header = getSafeName(translate[header])
     fastaWrite(sys.stdout, header, seq)
@@ -0,0 +1,21 @@
+"""Reading the translation files PASTA writes, which map the IDs it
+gives the input sequences back to their original names."""
+
+def readTranslateFile(path):
+    """Get a dict of PASTA ID -> original name from a translation file
+    (records of three lines: the ID, the original name, and a blank
+    line)."""
+    translate = {}
+    curPastaID = None
+    for i, line in enumerate(open(path)):
+        line = line.strip()
+        if i % 3 == 0:
+            curPastaID = line
+        elif i % 3 == 1:
+            translate[curPastaID] = line
+    return translate
+
+def getSafeName(name):
+    """Get a version of an original sequence name without the periods
+    that the rest of the pipeline can't handle."""
+    return name.replace("...", ".-.").replace(".", "_").replace("__", "_")
@@ -1,41 +1,23 @@
 #!/usr/bin/env python
+# Usage: renameNewick.py renameFile newickFile
+# Rename the PASTA IDs in a tree to their original (safe) names, and
+# induce the tree on the renamed leaves.
 import sys
-from sonLib.bioio import fastaRead
-from sonLib.nxnewick import NXNewick
-from sonLib.nxtree import NXTree
-import networkx as nx
+from array import array
+from compactTree import parseCompactNewick
+from pastaNames import readTranslateFile, getSafeName
 
-def induceTreeOnLeaves(nxtree, leaves):
+def induceTreeOnLeaves(tree, leaves):
+    """Get the newick for the tree induced on the leaves of a
+    CompactTree with the given names."""
     leaves = set(leaves)
-    dg = nxtree.nxDg
-    nodesToKeep = []
-    for node in dg.nodes():
-        succ = set([nxtree.getName(i) for i in nx.dfs_postorder_nodes(dg, node) if nxtree.hasName(i)])
-        if len(succ.intersection(leaves)) != 0:
-            nodesToKeep.append(node)
-    return NXTree(dg.subgraph(nodesToKeep))
+    keep = array('b', [0]) * len(tree)
+    for id in tree.leafIds:
+        keep[id] = tree.getName(id) in leaves
+    return tree.getInducedNewick(keep)
 
-renameFile = open(sys.argv[1])
-newickFile = open(sys.argv[2])
-
-translate = {}
-curPastaID = None
-curRealName = None
-for i, line in enumerate(renameFile):
-    line = line.strip()
-    if i % 3 == 0:
-        curPastaID = line
-    elif i % 3 == 1:
-        curRealName = line
-    else:
-        translate[curPastaID] = curRealName.replace("...", ".-.").replace(".", "_").replace("__", "_")
-
-s = newickFile.read()
-for header1, header2 in translate.items():
-    s = s.replace(header1, header2)
-
-tree = NXNewick().parseString(s)
-
-inducedTree = induceTreeOnLeaves(tree, translate.values())
-
-print NXNewick().writeString(inducedTree)
+if __name__ == '__main__':
+    translate = dict((pastaID, getSafeName(name)) for pastaID, name in readTranslateFile(sys.argv[1]).items())
+    # Renamed as it's parsed, so only whole labels are translated.
+    tree = parseCompactNewick(open(sys.argv[2]).read(), translate)
+    print induceTreeOnLeaves(tree, translate.values())